@@ -0,0 +1,3 @@
+# netQuil benchmarks, written in the style of airspeed velocity (asv): every class defines
+# params, param_names and setup, and each method starting with time_ is a benchmark.
+# Run them with asv, or without it with python -m benchmarks (see __main__.py).
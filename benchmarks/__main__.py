@@ -0,0 +1,134 @@
+'''
+Runs netQuil's benchmarks without asv and optionally exports the results as JSON, e.g.
+
+    python -m benchmarks --json results.json
+    python -m benchmarks --filter Clock --repeat 10
+'''
+import argparse
+import datetime
+import importlib
+import inspect
+import itertools
+import json
+import pkgutil
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pyquil
+
+import benchmarks
+
+def discover(pattern=None):
+    '''
+    Find every benchmark of the modules of this package starting with bench_
+
+    :param String pattern: only keep benchmarks whose name contains pattern
+    :return: list of tuples of name, class and method name
+    '''
+    found = []
+    for module_info in pkgutil.iter_modules(benchmarks.__path__):
+        if not module_info.name.startswith('bench_'):
+            continue
+        module = importlib.import_module('benchmarks.' + module_info.name)
+        for class_name, cls in inspect.getmembers(module, inspect.isclass):
+            if cls.__module__ != module.__name__:
+                continue
+            for method in sorted(m for m in vars(cls) if m.startswith('time_')):
+                name = '{}.{}.{}'.format(module_info.name, class_name, method)
+                if pattern is None or pattern in name:
+                    found.append((name, cls, method))
+    return found
+
+def parameters(cls):
+    '''
+    :param Class cls: benchmark class
+    :return: list of dictionaries of parameters, one for each combination of cls.params
+    '''
+    params = getattr(cls, 'params', [])
+    names = getattr(cls, 'param_names', [])
+    if not params:
+        return [{}]
+    # asv allows a single list of params for classes with a single parameter
+    if not isinstance(params[0], (list, tuple)):
+        params = [params]
+    names = names or ['param{}'.format(i + 1) for i in range(len(params))]
+    return [dict(zip(names, combination)) for combination in itertools.product(*params)]
+
+def measure(cls, method, params, repeat):
+    '''
+    Time a benchmark, calling setup before and teardown after every call
+
+    :param Class cls: benchmark class
+    :param String method: name of benchmark method
+    :param Dict params: parameters of benchmark
+    :param Int repeat: number of times to time the benchmark
+    :return: list of times in seconds
+    '''
+    args = list(params.values())
+    times = []
+    for _ in range(repeat):
+        instance = cls()
+        if hasattr(instance, 'setup'):
+            instance.setup(*args)
+        try:
+            start = time.perf_counter()
+            getattr(instance, method)(*args)
+            times.append(time.perf_counter() - start)
+        finally:
+            if hasattr(instance, 'teardown'):
+                instance.teardown(*args)
+    return times
+
+def environment():
+    '''
+    :return: dictionary describing the machine, versions and commit the benchmarks ran on
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'commit': commit,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pyquil': pyquil.__version__,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run netQuil benchmarks')
+    parser.add_argument('--filter', help='only run benchmarks whose name contains this string')
+    parser.add_argument('--repeat', type=int, default=None, help='number of timings of each benchmark, defaults to the repeat of its class')
+    parser.add_argument('--json', help='file to write results to')
+    args = parser.parse_args(argv)
+
+    results = []
+    for name, cls, method in discover(args.filter):
+        for params in parameters(cls):
+            repeat = args.repeat or getattr(cls, 'repeat', 5)
+            times = measure(cls, method, params, repeat)
+            results.append({
+                'name': name,
+                'params': params,
+                'min': min(times),
+                'median': statistics.median(times),
+                'max': max(times),
+                'times': times,
+            })
+            label = ', '.join('{}={}'.format(k, v) for k, v in params.items())
+            print('{:<60} {:<30} {:>12.6f} s'.format(name, label, results[-1]['median']))
+            sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
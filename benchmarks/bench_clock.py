@@ -0,0 +1,25 @@
+from netQuil import *
+
+class MasterClockSuite:
+    '''
+    Rate at which the master clock records transactions and renders them
+    '''
+    params = [1000, 10000, 100000]
+    param_names = ['transactions']
+    number = 1
+    repeat = 5
+
+    def setup(self, transactions):
+        self.master_clock = MasterClock()
+        self.recorded = MasterClock()
+        for i in range(transactions):
+            self.recorded.record_qtransaction(i * 1e-9, 'sent', 'Alice', 'Bob', [i % 8])
+
+    def time_record(self, transactions):
+        record = self.master_clock.record_qtransaction
+        for i in range(transactions):
+            record(i * 1e-9, 'sent', 'Alice', 'Bob', [i % 8])
+        self.master_clock.to_array()
+
+    def time_transactions(self, transactions):
+        self.recorded.transactions
@@ -0,0 +1,57 @@
+from netQuil import *
+from pyquil import Program
+
+class ConnectionSuite:
+    '''
+    Throughput of sending qubits over a QConnect and receiving them, without a simulation
+    '''
+    params = ([1, 10], [False, True])
+    param_names = ['qubits_per_send', 'devices']
+    number = 1
+    repeat = 5
+    num_qubits = 1000
+
+    def setup(self, qubits_per_send, devices):
+        program = Program()
+        self.alice = Agent(program, qubits=list(range(self.num_qubits)), name='Alice')
+        self.bob = Agent(program, name='Bob')
+        if devices:
+            self.alice.add_source_devices([Laser(expected_photons=1)])
+            self.bob.add_target_devices([Fiber(length=1)])
+        QConnect(self.alice, self.bob, transit_devices=[Fiber(length=10) for _ in range(devices * 4)])
+
+        master_clock = MasterClock()
+        self.alice.master_clock = master_clock
+        self.bob.master_clock = master_clock
+        qubits = list(self.alice.qubits)
+        self.bursts = [qubits[i:i + qubits_per_send] for i in range(0, len(qubits), qubits_per_send)]
+
+    def time_qsend_qrecv(self, qubits_per_send, devices):
+        for burst in self.bursts:
+            self.alice.qsend('Bob', burst)
+            self.bob.qrecv('Alice')
+
+class ClassicalConnectionSuite:
+    '''
+    Throughput of sending cbits over a CConnect and receiving them, without a simulation
+    '''
+    params = [1, 10]
+    param_names = ['cbits_per_send']
+    number = 1
+    repeat = 5
+    num_messages = 1000
+
+    def setup(self, cbits_per_send):
+        program = Program()
+        self.alice = Agent(program, name='Alice')
+        self.bob = Agent(program, name='Bob')
+        CConnect(self.alice, self.bob, length=1.0)
+        master_clock = MasterClock()
+        self.alice.master_clock = master_clock
+        self.bob.master_clock = master_clock
+        self.cbits = [1] * cbits_per_send
+
+    def time_csend_crecv(self, cbits_per_send):
+        for _ in range(self.num_messages):
+            self.alice.csend('Bob', self.cbits)
+            self.bob.crecv('Alice')
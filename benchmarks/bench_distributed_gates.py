@@ -0,0 +1,42 @@
+from netQuil import *
+from pyquil import Program
+
+class Controller(Agent):
+    '''
+    Entangles its control qubit with a qubit of every target and disentangles them again
+    '''
+    def run(self):
+        psi, measure_qubit = self.qubits[0], self.qubits[1]
+        targets = [(target, target.qubits[0]) for target in self.targets]
+        cat_entangler(control=(self, psi, measure_qubit, self.ro), targets=targets)
+        cat_disentangler(control=(self, psi, self.ro), targets=targets)
+
+class Target(Agent):
+    def run(self):
+        pass
+
+class CatSuite:
+    '''
+    cat_entangler followed by cat_disentangler with a growing number of target agents
+    '''
+    params = [2, 8, 32]
+    param_names = ['targets']
+    number = 1
+    repeat = 5
+
+    def setup(self, targets):
+        program = Program()
+        ro = program.declare('ro', 'BIT', targets + 2)
+        controller = Controller(program, qubits=[0, 1], name='Controller')
+        controller.ro = ro
+        controller.targets = [Target(program, qubits=[i + 2], name='Target{}'.format(i)) for i in range(targets)]
+        for target in controller.targets:
+            QConnect(controller, target)
+            CConnect(controller, target)
+        self.simulation = Simulation(controller, *controller.targets)
+
+    def teardown(self, targets):
+        self.simulation.close()
+
+    def time_cat_entangler_disentangler(self, targets):
+        self.simulation.run(trials=10, seed=0)
@@ -0,0 +1,34 @@
+from netQuil import *
+from pyquil import Program
+from pyquil.gates import H
+
+class NoiseSuite:
+    '''
+    Noise applied to 100 qubits of programs of growing size
+    '''
+    params = [100, 1000, 10000]
+    param_names = ['instructions']
+    number = 1
+    repeat = 5
+    num_qubits = 100
+
+    def setup(self, instructions):
+        self.program = Program()
+        self.program.declare('ro', 'BIT', self.num_qubits)
+        for i in range(instructions):
+            self.program += H(i % self.num_qubits)
+        self.noise_model = NoiseModel(('bit_flip', 0.01), ('phase_flip', 0.01), ('depolarizing', 0.01))
+
+    def time_measure(self, instructions):
+        for q in range(self.num_qubits):
+            noise.measure(self.program, q, 0.5, 'Fiber')
+
+    def time_measure_batch(self, instructions):
+        noise.measure_batch(self.program, list(range(self.num_qubits)), 0.5, 'Fiber')
+
+    def time_bit_flip(self, instructions):
+        for q in range(self.num_qubits):
+            noise.bit_flip(self.program, q, 0.01)
+
+    def time_noise_model(self, instructions):
+        self.noise_model.apply(self.program, range(self.num_qubits))
@@ -0,0 +1,41 @@
+from netQuil import *
+from .networks import chain
+
+class SimulationSuite:
+    '''
+    Simulation.run and run_batched on chains of agents passing 10 qubits through fibers
+    '''
+    params = ([1, 10, 100], [2, 4, 8])
+    param_names = ['trials', 'agents']
+    number = 1
+    repeat = 5
+
+    def setup(self, trials, agents):
+        self.simulation = chain(agents, 10)
+
+    def teardown(self, trials, agents):
+        self.simulation.close()
+
+    def time_run(self, trials, agents):
+        self.simulation.run(trials=trials, seed=0)
+
+    def time_run_batched(self, trials, agents):
+        self.simulation.run_batched(trials=trials, seed=0)
+
+class EventSimulationSuite:
+    '''
+    EventSimulation.run on chains of agents passing 10 qubits through fibers
+    '''
+    params = ([1, 10, 100], [2, 4, 8])
+    param_names = ['trials', 'agents']
+    number = 1
+    repeat = 5
+
+    def setup(self, trials, agents):
+        self.simulation = chain(agents, 10, simulation=EventSimulation)
+
+    def teardown(self, trials, agents):
+        self.simulation.close()
+
+    def time_run(self, trials, agents):
+        self.simulation.run(trials=trials, seed=0)
@@ -0,0 +1,68 @@
+from netQuil import *
+from pyquil import Program
+
+class Source(Agent):
+    '''
+    Sends each of its qubits, one at a time, to the next agent of the chain
+    '''
+    def run(self):
+        for q in self.qubits:
+            self.qsend(self.next, [q])
+
+class Relay(Agent):
+    '''
+    Forwards every burst of qubits received from the previous agent of the chain to the next
+    '''
+    def run(self):
+        for _ in range(self.num_qubits):
+            # Qubits lost on the way are forwarded as an empty burst, so the rest of the chain does not wait for them
+            self.qsend(self.next, self.qrecv(self.previous))
+
+class Sink(Agent):
+    '''
+    Receives every qubit sent down the chain
+    '''
+    def run(self):
+        for _ in range(self.num_qubits):
+            self.qrecv(self.previous)
+
+class AsyncSource(AsyncAgent):
+    async def run(self):
+        for q in self.qubits:
+            await self.qsend(self.next, [q])
+
+class AsyncRelay(AsyncAgent):
+    async def run(self):
+        for _ in range(self.num_qubits):
+            await self.qsend(self.next, await self.qrecv(self.previous))
+
+class AsyncSink(AsyncAgent):
+    async def run(self):
+        for _ in range(self.num_qubits):
+            await self.qrecv(self.previous)
+
+def chain(num_agents, num_qubits, fiber_length=1.0, simulation=Simulation):
+    '''
+    Simulation of agents passing qubits down a chain, with a fiber between each pair of agents
+
+    :param Int num_agents: number of agents, at least 2
+    :param Int num_qubits: number of qubits the first agent sends
+    :param Float fiber_length: length of each fiber in km
+    :param Class simulation: class of simulation, agents are AsyncAgents for subclasses of AsyncSimulation
+    :return: simulation
+    '''
+    source, relay, sink = (AsyncSource, AsyncRelay, AsyncSink) if issubclass(simulation, AsyncSimulation) else (Source, Relay, Sink)
+    program = Program()
+    names = ['agent{}'.format(i) for i in range(num_agents)]
+    agents = [source(program, qubits=list(range(num_qubits)), name=names[0])]
+    agents += [relay(program, name=name) for name in names[1:-1]]
+    agents += [sink(program, name=names[-1])]
+
+    for i, agent in enumerate(agents):
+        agent.num_qubits = num_qubits
+        agent.previous = names[i - 1] if i > 0 else None
+        agent.next = names[i + 1] if i < num_agents - 1 else None
+
+    for left, right in zip(agents, agents[1:]):
+        QConnect(left, right, transit_devices=[Fiber(length=fiber_length)])
+    return simulation(*agents)
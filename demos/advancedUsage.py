@@ -10,6 +10,7 @@ import numpy as np
 ####################################################
 class Simple_Fiber(Device): 
     def __init__(self, length, fiber_quality, rotation_std):
+       super().__init__()
        self.fiber_quality = fiber_quality
        self.length = length
        self.rotation_std = rotation_std
@@ -18,8 +19,8 @@ class Simple_Fiber(Device):
     def apply(self, program, qubits):
         for qubit in qubits: 
             # Apply noise
-            if np.random.rand() > self.fiber_quality:
-                rotation_angle = np.random.normal(0, self.rotation_std)
+            if self.rng.random() > self.fiber_quality:
+                rotation_angle = self.rng.normal(0, self.rotation_std)
                 program += RX(rotation_angle, qubit)
 
         delay = self.length/self.signal_speed
@@ -40,9 +41,8 @@ class Bob(Agent):
     def run(self):
         p = self.program
         for _ in range(3): 
-            q = self.qrecv(alice.name)[0]
-            # If qubit is not lost
-            if q >= 0: 
+            # Lost qubits are not received
+            for q in self.qrecv(alice.name):
                 p += MEASURE(q, ro[q])
 
 p = Program()
@@ -64,7 +64,7 @@ QConnect(alice, bob, transit_devices=[fiber, custom_fiber])
 programs = Simulation(alice, bob).run(trials=10, agent_classes=[Alice, Bob]) 
 
 # Run programs
-qvm = QVMConnection()
+simulator = DensityMatrixSimulator()
 for idx, program in enumerate(programs): 
-    results = qvm.run(program)
+    results = simulator.run(program)
     print('Program {}: '.format(idx), results)
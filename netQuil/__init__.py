@@ -3,9 +3,19 @@
 name = 'netQuil' 
 # Load all modules
 from netQuil.agents import *
+from netQuil.register import *
 from netQuil.simulator import *
 from netQuil.connections import *
 from netQuil.devices import *
 from netQuil.noise import *
 from netQuil.clock import *
-from netQuil.distributedGates import *
\ No newline at end of file
+from netQuil.profiling import *
+from netQuil.distributedGates import *
+from netQuil.ir import *
+from netQuil.template import *
+from netQuil.executor import *
+from netQuil.stabilizer import *
+from netQuil.optimize import *
+from netQuil.batch import *
+from netQuil.asynchronous import *
+from netQuil.scheduler import *
\ No newline at end of file
@@ -1,11 +1,24 @@
-import inspect
-import sys
+import contextlib
+import contextvars
+import copy
 import threading
 import time
+import numpy as np
+
+from pyquil import Program
+from pyquil.quilatom import Qubit
+from pyquil.quilbase import AbstractInstruction, Declare, DefGate, Gate, Measurement, Pragma, ResetQubit
+from .ir import InstructionBuffer, _memory_regions
+from .optimize import NOISE_PRAGMAS
+from .register import QubitRegister
+from netQuil import profiling
 
 __all__ = ["Agent"]
 
-class Agent(threading.Thread):
+# Agent whose run-time logic is running in the current thread or task
+_current_agent = contextvars.ContextVar('current_agent', default=None)
+
+class Agent:
     def __init__(self, program=None, qubits=[], cmem=[], name=None):
         '''
         Agents are codified versions of Alice and Bob (i.e. single nodes in a quantum network) 
@@ -16,14 +29,14 @@ class Agent(threading.Thread):
         * Their connections to other agents are by default ingress and egress 
         * Agents' manage their own target and source devices for noise and local time tracking
         * Agents have a network monitor to record the traffic they see
+        * Agents are run by a Simulation's pool of workers, which is reused across trials
+        * Agents draw random numbers from their own generator, self.rng, seeded by the Simulation each trial
 
         :param PyQuil<Program> program: program
-        :param List<int> qubits: list of qubits owned by agent
+        :param List<int> qubits: list of qubits owned by agent, kept in a QubitRegister
         :param List<int> cmem: list of cbits owned by agent
         :param String name: name of agent, defaults to name of class
         '''
-        threading.Thread.__init__(self)
-
         # Name of the agent, e.g. "Alice". Defaults to the name of the class.
         if name is not None:
             self.name = name
@@ -44,18 +57,54 @@ class Agent(threading.Thread):
         self.target_devices = []
         self.source_devices = []
 
+        # Lamport clock ordering the agent's instructions with those of other agents. Advanced past 
+        # the logical time of every qubit and cbit the agent receives (see Simulation.run)
+        self.logical_time = 0
+
         self.master_clock = None
         self.network_monitor_running = False
         self.using_distributed_gate = False
 
+        # Random number generator of the agent, replaced with a seeded generator each trial (see Simulation.run)
+        self.rng = np.random.default_rng()
+
     def get_master_time(self): 
         '''
         :return: master time
         '''
         return self.master_clock.get_time()
 
-    def _start_tracer(self):
-        threading.settrace(self._tracer)
+    def _execute(self):
+        '''
+        Run agent on the current worker, checking the instructions it adds to its program
+        '''
+        token = _current_agent.set(self)
+        profiler = profiling.profiler
+        start = time.perf_counter() if profiler is not None else None
+        try:
+            self.run()
+        finally:
+            _current_agent.reset(token)
+            if profiler is not None:
+                profiler.record_agent(self.name, time.perf_counter() - start)
+
+    def snapshot(self):
+        '''
+        Capture the agent's state so that it can be restored between trials. Containers 
+        (e.g. qubits and cmem) are copied, while their contents are shared.
+
+        :return: dictionary of agent's attributes
+        '''
+        return _copy_attributes(self.__dict__)
+
+    def restore(self, snapshot):
+        '''
+        Restore the agent's state from a snapshot. The snapshot may be restored many times.
+
+        :param Dict snapshot: dictionary of agent's attributes from snapshot
+        '''
+        self.__dict__.clear()
+        self.__dict__.update(_copy_attributes(snapshot))
 
     def _get_device_results(self):
         '''
@@ -63,34 +112,40 @@ class Agent(threading.Thread):
         '''
         devices = self.source_devices + self.target_devices
         for device in devices: 
-            if device.verbose:
-                device.get_results()
+            device.get_results()
  
     def update_network_monitor(self, qubits, bar):
         for _ in qubits: 
             time.sleep(0.05)
             bar.update()
 
-    def _tracer(self, frame, event, arg):
+    def _check_instruction(self, instruction):
         '''
         Prevents agent from modifying qubits that it does not own and manage by
-        examining the frame and intercepting all pyquil.gates calls 
-        '''
-        if event == "call":
-            if self.using_distributed_gate: 
-                return self._tracer
-            if frame.f_globals['__name__'] == 'pyquil.gates':
-                # Returns dictionary of parameter names and their values
-                argsToGate = inspect.getargvalues(frame)
-                # Extract parameter values 
-                argValues = list(argsToGate.locals.values())
-                # Extract parameter values that are integers (ignore iterator arguments)
-                qubits = [q for q in argValues if type(q) == int]
-                # Check that qubits are a subset of the Agent's qubits
-                if not all(q in self.qubits for q in qubits):
-                    raise Exception('Agent cannot modify qubits they do not own (including qubits that have been lost)')
-
-        return self._tracer
+        examining the qubits of each gate, measurement and reset added to its program
+
+        :param AbstractInstruction instruction: instruction being added to the program
+        '''
+        if isinstance(instruction, Gate):
+            qubits = instruction.qubits
+        elif isinstance(instruction, (Measurement, ResetQubit)) and instruction.qubit is not None:
+            qubits = [instruction.qubit]
+        else:
+            return
+        # Qubit placeholders have no index and are not checked
+        self._check_qubits([getattr(qubit, 'index', qubit) for qubit in qubits])
+
+    def _check_qubits(self, qubits):
+        '''
+        Prevents agent from modifying qubits that it does not own and manage
+
+        :param List<int> qubits: indices of qubits an instruction acts on
+        '''
+        if self.using_distributed_gate:
+            return
+        for index in qubits:
+            if isinstance(index, int) and index not in self.qubits:
+                raise Exception('Agent cannot modify qubits they do not own (including qubits that have been lost)')
     
     def set_program(self, program):
         '''
@@ -118,6 +173,19 @@ class Agent(threading.Thread):
         '''
         self.source_devices.extend(new_source_devices)
 
+    @property
+    def qubits(self):
+        return self.__qubits
+
+    @qubits.setter
+    def qubits(self, qubits):
+        '''
+            Set qubits owned by agent
+
+            :param List<int> qubits: qubits owned by agent
+        '''
+        self.__qubits = qubits if isinstance(qubits, QubitRegister) else QubitRegister(qubits)
+
     @property
     def cmem(self): 
         return self.__cmem
@@ -183,14 +251,14 @@ class Agent(threading.Thread):
         :param List<int> qubits: list of qubits to send to destination
         '''
         # Raise exception if agent sends qubits they do no have
-        if not set(qubits).issubset(set(self.qubits)): 
+        if not self.qubits.issuperset(qubits): 
             raise Exception('Agent cannot send qubits they do not have')
             
         connection = self.qconnections[target]
-        source_delay = connection.put(self.name, target, qubits, self.time)
+        source_delay = connection.put(self.name, target, qubits, self.time, self.logical_time)
     
         # Removing qubits being sent
-        self.qubits = list(set(self.qubits) - set(qubits))
+        self.qubits.difference_update(qubits)
 
         # Update Agent's Time
         self.time += source_delay
@@ -205,13 +273,26 @@ class Agent(threading.Thread):
     def qrecv(self, source):
         '''
         Agent receives qubits from source. Adds qubits to agent's list of qubits and
-        add time delay. Return list of qubits
+        add time delay. Return list of qubits. Qubits lost in transmission are not 
+        returned, and are recorded in self.qubits.lost instead
         
         :param String source: name of agent who sent qubits.
-        :return: list of qubits sent from source
+        :return: list of qubits sent from source that were not lost
         '''
         connection = self.qconnections[source]
-        qubits, delay, source_time = connection.get(self)
+        return self._record_qrecv(source, *connection.get(self))
+
+    def _record_qrecv(self, source, qubits, lost_qubits, delay, source_time):
+        '''
+        Update agent's time, master clock and network monitor after receiving qubits
+
+        :param String source: name of agent who sent qubits
+        :param List<int> qubits: qubits received
+        :param List<int> lost_qubits: qubits lost in transmission
+        :param Float delay: time qubits took to travel
+        :param Float source_time: time of source when qubits were sent
+        :return: list of qubits sent from source that were not lost
+        '''
         self.time = max(source_time + delay, self.time) 
 
         # Update Master Clock
@@ -230,7 +311,7 @@ class Agent(threading.Thread):
         :param List<int> cbits: indices of cbits source is sending to target
         '''
         connection = self.cconnections[target]
-        source_delay  = connection.put(target, cbits)
+        source_delay  = connection.put(target, cbits, self.logical_time)
         scaled_source_delay = source_delay*len(cbits)
         self.time += scaled_source_delay
         
@@ -245,7 +326,17 @@ class Agent(threading.Thread):
         :return: list of cbits sent from source
         '''
         connection = self.cconnections[source]
-        cbits, delay = connection.get(self.name)
+        return self._record_crecv(source, *connection.get(self.name))
+
+    def _record_crecv(self, source, cbits, delay):
+        '''
+        Update agent's time and master clock after receiving cbits
+
+        :param String source: name of agent who sent cbits
+        :param List<int> cbits: cbits received
+        :param Float delay: time cbits took to travel
+        :return: list of cbits sent from source
+        '''
         self.time += delay
 
         #Update Master Clock
@@ -256,3 +347,224 @@ class Agent(threading.Thread):
     def run(self):
         '''Run-time logic for the Agent; this method should be overridden in child classes.'''
         pass
+
+class _InstructionHook:
+    def __init__(self, program):
+        '''
+        Replaces Program.inst on a program shared by agents. Program.inst handles every way of 
+        adding instructions (e.g. +=, if_then, measure), and calls itself on each instruction 
+        before appending it, so the hook sees every instruction added while an agent is running. 
+        Each instruction is checked against the qubits the agent owns (see Agent._check_instruction) 
+        and, while buffering, recorded in the agent's own InstructionBuffer with the agent's logical 
+        time rather than appended to the program (see _InstructionHook.merge). Declarations, gate 
+        definitions and noise pragmas are not checked, and are buffered as definitions.
+
+        :param PyQuil<Program> program: program shared by agents
+        '''
+        self.program = program
+        self.check = True
+        self.buffers = None
+        # Serializes changes agents make to the program's shared declarations and definitions (see program_lock)
+        self.lock = threading.RLock()
+
+    def __getstate__(self):
+        '''
+        Hooks are pickled, with their program, without their lock
+        '''
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def __call__(self, *instructions):
+        agent = _current_agent.get()
+        if agent is None:
+            return Program.inst(self.program, *instructions)
+
+        for instruction in instructions:
+            if not isinstance(instruction, AbstractInstruction):
+                Program.inst(self.program, instruction)
+                continue
+            if isinstance(instruction, (Declare, DefGate)) or \
+                    (isinstance(instruction, Pragma) and instruction.command in NOISE_PRAGMAS):
+                if self.buffers is None:
+                    Program.inst(self.program, instruction)
+                else:
+                    self.buffer(agent).define([instruction], agent.logical_time)
+                continue
+            if self.check:
+                agent._check_instruction(instruction)
+            if self.buffers is None:
+                Program.inst(self.program, instruction)
+            else:
+                self.buffer(agent).append(instruction, agent.logical_time)
+        return self.program
+
+    def buffer(self, agent):
+        '''
+        :param Agent agent: agent adding instructions
+        :return: the agent's InstructionBuffer
+        '''
+        buffer = self.buffers.get(agent.name)
+        if buffer is None:
+            buffer = self.buffers[agent.name] = InstructionBuffer()
+        return buffer
+
+    def start(self):
+        '''
+        Start buffering the instructions of each agent
+        '''
+        self.buffers = {}
+
+    def merge(self, names):
+        '''
+        Stop buffering and append the buffered instructions to the program in causal order: 
+        by logical time, and by the order of names for instructions with the same logical time. 
+        Each agent's instructions keep the order they were added in. Definitions are added 
+        before the other instructions, skipping those already in the program (see noise._apply_channel).
+        Bits read out into are given their offsets in the order of names, after the bits the 
+        program or agents already declare, and their registers are declared or extended to fit them. 
+        A register declared by the program or by an earlier agent is not declared again.
+
+        :param List<String> names: names of agents in the order of the simulation
+        '''
+        buffers, self.buffers = self.buffers, None
+        if not buffers:
+            return
+        buffers = [buffers[name] for name in names if name in buffers]
+        program = self.program
+
+        defined = {gate.name for gate in program.defined_gates}
+        defined.update(getattr(program, '_noisy_qubits', None) or ())
+        definitions = InstructionBuffer.merge_definitions(buffers, defined)
+
+        # Registers are declared once: by the program, or else by the first agent declaring them
+        regions = _memory_regions(program)
+        sizes = {name: program._instructions[position].memory_size for name, position in regions.items()}
+        declarations = {}
+        for instruction in definitions:
+            if isinstance(instruction, Declare) and instruction.name not in sizes:
+                declarations[instruction.name] = instruction
+                sizes[instruction.name] = instruction.memory_size
+
+        readout_offsets = []
+        for buffer in buffers:
+            readout_offsets.append({name: sizes.get(name, 0) for name in buffer.readout_sizes})
+            for name, size in buffer.readout_sizes.items():
+                sizes[name] = sizes.get(name, 0) + size
+        readout_names = sorted(set().union(*(buffer.readout_sizes for buffer in buffers)))
+        for name in readout_names:
+            if name in regions:
+                declaration = program._instructions[regions[name]]
+                program._instructions[regions[name]] = Declare(name, declaration.memory_type, sizes[name])
+            elif name not in declarations:
+                Program.inst(program, Declare(name, 'BIT', sizes[name]))
+
+        for instruction in definitions:
+            if isinstance(instruction, Declare):
+                if declarations.get(instruction.name) is not instruction:
+                    continue
+                if sizes[instruction.name] != instruction.memory_size:
+                    instruction = Declare(instruction.name, instruction.memory_type, sizes[instruction.name],
+                                          instruction.shared_region, instruction.offsets)
+            Program.inst(program, instruction)
+        # Noisy qubits are indexed again from the program's pragmas when next needed
+        program._noisy_qubits = None
+
+        # Instructions were checked as they were buffered, and none are definitions
+        program._instructions.extend(InstructionBuffer.merge(buffers, readout_offsets))
+        program._synthesized_instructions = None
+
+def agent_buffer(program, qubits=()):
+    '''
+    Buffer of the agent running, for noise and devices recording instructions without building
+    pyquil instructions (see add_gate)
+
+    :param PyQuil<Program> program: program shared by agents
+    :param List<int> qubits: qubits instructions are recorded for, checked against those the agent owns
+    :return: tuple of the agent's InstructionBuffer and logical time, or None if agents' instructions are not buffered
+    '''
+    agent = _current_agent.get()
+    hook = program.__dict__.get('inst')
+    if agent is None or not isinstance(hook, _InstructionHook) or hook.buffers is None:
+        return None
+    if hook.check:
+        agent._check_qubits(qubits)
+    return hook.buffer(agent), agent.logical_time
+
+def add_gate(program, name, qubits, params=()):
+    '''
+    Add a gate to a program without building a pyquil Gate while agents' instructions are buffered
+    (e.g. for the rotations and measurements of devices and noise, see noise.measure)
+
+    :param PyQuil<Program> program: program to add gate to
+    :param String name: name of gate, e.g. RX
+    :param List<int> qubits: qubits of gate
+    :param List<float> params: parameters of gate
+    '''
+    buffered = agent_buffer(program, qubits)
+    if buffered is None:
+        program += Gate(name, params, [Qubit(q) for q in qubits])
+        return
+    buffer, time = buffered
+    buffer.gate(name, qubits, params, time)
+
+def add_measurement(program, qubit, reference):
+    '''
+    Add a measurement to a program without building a pyquil Measurement while agents' 
+    instructions are buffered (see add_gate)
+
+    :param PyQuil<Program> program: program to add measurement to
+    :param Int qubit: qubit to measure
+    :param MemoryReference reference: bit to store the result in
+    '''
+    buffered = agent_buffer(program, [qubit])
+    if buffered is None:
+        program += Measurement(Qubit(qubit), reference)
+        return
+    buffer, time = buffered
+    buffer.measure(qubit, reference, time)
+
+def program_lock(program):
+    '''
+    Lock held while reading and then changing what a program declares or defines (e.g. 
+    allocating a readout bit, see noise.readout_slot), which agent threads may do concurrently
+
+    :param PyQuil<Program> program: program shared by agents
+    :return: the lock of the program's hook, or a context doing nothing if agents are not running on it
+    '''
+    hook = program.__dict__.get('inst')
+    return hook.lock if isinstance(hook, _InstructionHook) else contextlib.nullcontext()
+
+def instruction_hook(program, check=True):
+    '''
+    :param PyQuil<Program> program: program shared by agents
+    :param Boolean check: whether instructions are checked (see check_ownership)
+    :return: the hook installed on program, installing one if needed
+    '''
+    hook = program.__dict__.get('inst')
+    if not isinstance(hook, _InstructionHook):
+        hook = program.inst = _InstructionHook(program)
+    hook.check = check
+    return hook
+
+def check_ownership(program, enabled=True):
+    '''
+    Turn checking of the qubits agents add instructions for on or off for a program
+
+    :param PyQuil<Program> program: program shared by agents
+    :param Boolean enabled: whether instructions are checked
+    '''
+    instruction_hook(program, enabled)
+
+def _copy_attributes(attributes):
+    '''
+    Copy a dictionary of attributes, copying containers one level deep
+
+    :param Dict attributes: attributes to copy
+    :return: copy of attributes
+    '''
+    return {k: copy.copy(v) if isinstance(v, (list, dict, set, QubitRegister)) else v for k, v in attributes.items()}
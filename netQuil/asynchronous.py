@@ -0,0 +1,139 @@
+import asyncio
+import time
+
+from .agents import Agent, _current_agent
+from .simulator import Simulation
+from netQuil import profiling
+
+__all__ = ["AsyncAgent", "AsyncSimulation"]
+
+class AsyncAgent(Agent):
+    '''
+    Agent whose run-time logic is a coroutine. Communication methods are awaitables backed by
+    asyncio queues, so an entire network of AsyncAgents runs on a single event loop instead of
+    one thread per agent (see AsyncSimulation). AsyncAgents share the constructor, devices and
+    bookkeeping of Agent, e.g.
+
+    .. code:: python
+
+        class Bob(AsyncAgent):
+            async def run(self):
+                q = await self.qrecv('Alice')
+
+    Distributed gates block on classical communication, and can only be used by Agents.
+    '''
+    async def qsend(self, target, qubits):
+        '''
+        Send qubits from agent to target. Connection will place qubits on queue
+        for target to retrieve.
+
+        :param String target: name of destination for qubits
+        :param List<int> qubits: list of qubits to send to destination
+        '''
+        Agent.qsend(self, target, qubits)
+
+    async def qrecv(self, source):
+        '''
+        Agent waits for qubits from source. Adds qubits to agent's list of qubits and
+        add time delay. Return list of qubits
+
+        :param String source: name of agent who sent qubits.
+        :return: list of qubits sent from source
+        '''
+        connection = self.qconnections[source]
+        return self._record_qrecv(source, *(await connection.aget(self)))
+
+    async def csend(self, target, cbits):
+        '''
+        Sends classical bits from agent to target.
+
+        :param String target: name of target agent
+        :param List<int> cbits: indices of cbits source is sending to target
+        '''
+        Agent.csend(self, target, cbits)
+
+    async def crecv(self, source):
+        '''
+        Wait for cbits from source.
+
+        :param String source: name of Agent where cbits originated from.
+        :return: list of cbits sent from source
+        '''
+        connection = self.cconnections[source]
+        return self._record_crecv(source, *(await connection.aget(self.name)))
+
+    async def run(self):
+        '''Run-time logic for the Agent; this coroutine should be overridden in child classes.'''
+        pass
+
+class AsyncSimulation(Simulation):
+    def __init__(self, *args, check_ownership=True, profile=False, buffer_instructions=True):
+        '''
+        Simulation of AsyncAgents running on a single event loop. The event loop is reused across
+        trials, and every connection between agents is given fresh asyncio queues before each trial.
+        AsyncSimulation supports the same methods and arguments as Simulation (e.g. run and run_batched).
+        '''
+        Simulation.__init__(self, *args, check_ownership=check_ownership, profile=profile, buffer_instructions=buffer_instructions)
+        self.loop = None
+
+    def _get_loop(self):
+        '''
+        Returns the event loop running agents, creating it on first use.
+        '''
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        return self.loop
+
+    def close(self):
+        '''
+        Close the simulation's event loop
+        '''
+        if self.loop is not None:
+            self.loop.close()
+            self.loop = None
+
+    def __getstate__(self):
+        '''
+        Simulations are pickled without their event loop
+        '''
+        state = Simulation.__getstate__(self)
+        state['loop'] = None
+        return state
+
+    async def _run_agent(self, agent):
+        '''
+        Run an agent as a task. Tasks run in their own context, so the agent is current 
+        (see Agent._execute) only while its own task is running.
+        '''
+        _current_agent.set(agent)
+        profiler = profiling.profiler
+        start = time.perf_counter() if profiler is not None else None
+        await agent.run()
+        if profiler is not None:
+            profiler.record_agent(agent.name, time.perf_counter() - start)
+
+    async def _run_agents(self):
+        '''
+        Run every agent as a task on the event loop, and wait for all of them to finish
+        '''
+        for connection in self._connections():
+            connection.queues = {name: asyncio.Queue() for name in connection.queues}
+
+        await asyncio.gather(*(self._run_agent(agent) for agent in self.agents))
+
+    def _run_trial(self, network_monitor=False):
+        '''
+        Run every agent once on the event loop
+
+        :param Boolean network_monitor: outputs each network transaction and device information
+        :return: program generated by the trial
+        '''
+        master_clock = self._start_trial()
+        self._get_loop().run_until_complete(self._run_agents())
+
+        if network_monitor:
+            for agent in self.agents:
+                agent._get_device_results()
+            master_clock.display_transactions()
+
+        return self.agents[0].program
@@ -0,0 +1,129 @@
+import threading
+import numpy as np
+
+__all__ = ["TrialSampler", "group_programs", "run_batches"]
+
+class TrialSampler:
+    def __init__(self, trials):
+        '''
+        Draws the random outcomes of devices and noise for many trials at once. Each replay
+        of the agents simulates a batch of trials sharing the same outcomes. The first time an 
+        outcome is drawn in a replay it is drawn for every trial of the batch as an array; the 
+        replay continues with the outcome of the batch's first trial, and trials with other 
+        outcomes are split off into new batches that are replayed later with those outcomes forced. 
+        The number of replays is therefore the number of structurally distinct trials rather than
+        the number of trials.
+
+        Outcomes are keyed on their kind, qubit, and how many outcomes of that kind the qubit 
+        has drawn so far in the replay, which does not depend on how agent threads are scheduled.
+
+        :param Int trials: number of trials to simulate
+        '''
+        self.pending = [({}, np.arange(trials))]
+        self.counted = {}
+        self.num_trials = trials
+        self.forced = {}
+        self.drawn = {}
+        self.counters = {}
+        self.trials = None
+        self.lock = threading.Lock()
+
+    def next_replay(self):
+        '''
+        Start replaying the next batch of trials.
+
+        :return: False if all trials have been simulated, otherwise True
+        '''
+        if not self.pending:
+            return False
+        self.forced, self.trials = self.pending.pop()
+        self.drawn = {}
+        self.counters = {}
+        return True
+
+    def _key(self, kind, qubit):
+        count = self.counters.get((kind, qubit), 0)
+        self.counters[(kind, qubit)] = count + 1
+        return (kind, qubit, count)
+
+    def sample(self, kind, qubit, draw):
+        '''
+        Draw an outcome that may change the program for every trial in the current batch
+
+        :param String kind: kind of outcome
+        :param Integer qubit: qubit the outcome applies to
+        :param Function draw: draws an array of outcomes given the number of trials
+        :return: outcome of the batch's first trial
+        '''
+        with self.lock:
+            key = self._key(kind, qubit)
+            if key in self.forced:
+                return self.forced[key]
+
+            values = np.asarray(draw(len(self.trials)))
+            outcome = values[0]
+            same = (values == outcome).reshape(len(values), -1).all(axis=1)
+
+            # Split off trials whose outcome differs, grouped by outcome
+            if not same.all():
+                others, inverse = np.unique(values[~same], axis=0, return_inverse=True)
+                split_trials = self.trials[~same]
+                for i, value in enumerate(others):
+                    forced = dict(self.forced)
+                    forced.update(self.drawn)
+                    forced[key] = value
+                    self.pending.append((forced, split_trials[inverse.reshape(-1) == i]))
+                self.trials = self.trials[same]
+
+            self.drawn[key] = outcome
+            return outcome
+
+    def tally(self, kind, qubit, draw):
+        '''
+        Draw outcomes recorded only in device statistics for trials of the current batch that
+        have not drawn them in an earlier replay
+
+        :param String kind: kind of outcome
+        :param Integer qubit: qubit the outcome applies to
+        :param Function draw: draws an array of outcomes given the number of trials
+        :return: array of outcomes
+        '''
+        with self.lock:
+            key = self._key(kind, qubit)
+            counted = self.counted.setdefault(key, np.zeros(self.num_trials, dtype=bool))
+            fresh = self.trials[~counted[self.trials]]
+            counted[fresh] = True
+            return np.asarray(draw(len(fresh)))
+
+def group_programs(programs):
+    '''
+    Group structurally identical programs so each group can be executed as a single multi-shot run
+
+    :param List programs: list of programs, or list of tuples of program and trial indices
+    :return: list of tuples of program and array of indices of the trials it represents
+    '''
+    groups = {}
+    for idx, item in enumerate(programs):
+        program, trials = item if isinstance(item, tuple) else (item, [idx])
+        key = program.out()
+        if key in groups:
+            groups[key][1].append(np.asarray(trials))
+        else:
+            groups[key] = (program, [np.asarray(trials)])
+    return [(program, np.sort(np.concatenate(trials))) for program, trials in groups.values()]
+
+def run_batches(batches, executor, classical_addresses=None):
+    '''
+    Execute each batch of trials as one multi-shot run
+
+    :param List batches: list of tuples of program and trial indices, e.g. from Simulation.run_batched
+    :param Executor executor: executor with a QVMConnection-like run method (e.g. DensityMatrixSimulator)
+    :param List<int> classical_addresses: offsets of ro to return, defaults to the entire register
+    :return: list of results, one for each trial, in trial order
+    '''
+    results = [None] * sum(len(trials) for _, trials in batches)
+    for program, trials in batches:
+        shots = executor.run(program, classical_addresses, trials=len(trials))
+        for trial, shot in zip(trials, shots):
+            results[trial] = shot
+    return results
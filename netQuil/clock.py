@@ -1,11 +1,148 @@
-import inspect
+import collections
+import itertools
+import threading
+import numpy as np
 
 __all__ = ["MasterClock"]
 
+# Codes of the kind and event type of recorded transactions
+QUANTUM, CLASSICAL = 0, 1
+SENT, RECEIVED = 0, 1
+EVENT_TYPES = {'sent': SENT, 'received': RECEIVED}
+
+TRANSACTION_DTYPE = np.dtype([
+    ('time', np.float64),
+    ('kind', np.uint8),
+    ('event', np.uint8),
+    ('source', np.int32),
+    ('target', np.int32),
+    ('offset', np.int64),
+    ('count', np.int32),
+])
+
 class MasterClock:
-    def __init__(self):
-        self.transactions = []
+    def __init__(self, capacity=256):
+        '''
+        Master clock of a simulation. Transactions are recorded as typed records in preallocated
+        columns that double in size when full: time, kind (quantum or classical), event type
+        (sent or received), source and target (indices into names), and the offset and count of
+        the transaction's qubits or cbits in a flat payload array. Cbits that are not integers (e.g. 
+        floats or strings sent with csend) are kept as they are in self.objects instead, and their
+        transactions have a negative offset, -1 - their index in self.objects. Recording a transaction only 
+        appends a tuple to a queue, which is written to the columns in bulk once it holds 
+        capacity transactions or when the columns are read. Transactions are only rendered as 
+        strings when displayed.
+
+        :param Int capacity: number of transactions preallocated
+        '''
         self.time = 0
+        self.names = []
+        self._name_ids = {}
+        self._records = np.zeros(capacity, dtype=TRANSACTION_DTYPE)
+        self._payload = np.zeros(4 * capacity, dtype=np.int64)
+        self._size = 0
+        self._payload_size = 0
+        self.objects = []
+        self._flush_size = capacity
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        '''
+        Master clocks are pickled without their lock and unused capacity
+        '''
+        records, payload = self.to_array().copy(), self.payload().copy()
+        state = self.__dict__.copy()
+        state['_records'] = records
+        state['_payload'] = payload
+        del state['_lock']
+        del state['_pending']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+
+    def _name_id(self, name):
+        '''
+        :param String name: name of agent
+        :return: index of name in self.names
+        '''
+        if name not in self._name_ids:
+            self._name_ids[name] = len(self.names)
+            self.names.append(name)
+        return self._name_ids[name]
+
+    def _record(self, time, kind, event_type, source, target, values):
+        '''
+        Update master clock and queue a transaction to be written to the columns
+
+        :param Float time: current time in seconds
+        :param Int kind: QUANTUM or CLASSICAL
+        :param String event_type: either sent or received. Otherwise, raise exception
+        :param String source: name of the agent sending
+        :param String target: name of the agent receiving
+        :param List values: qubits or cbits being sent from source to target
+        '''
+        if event_type not in EVENT_TYPES:
+            raise Exception('Event type must be "sent" or "received"')
+
+        # Update master clock
+        self.time = max(self.time, time)
+
+        self._pending.append((time, kind, EVENT_TYPES[event_type], source, target, tuple(values)))
+        if len(self._pending) >= self._flush_size:
+            self._flush()
+
+    def _flush(self):
+        '''
+        Write queued transactions to the columns, growing them if needed
+        '''
+        with self._lock:
+            rows = [self._pending.popleft() for _ in range(len(self._pending))]
+            if not rows:
+                return
+
+            times, kinds, events, sources, targets, values = zip(*rows)
+            counts = np.fromiter(map(len, values), dtype=np.int64, count=len(rows))
+            try:
+                flat = np.asarray(list(itertools.chain.from_iterable(values)))
+            except ValueError:
+                flat = np.empty(0, dtype=object)
+            if flat.dtype.kind in 'iu':
+                integral = np.ones(len(rows), dtype=bool)
+            else:
+                # Some cbits are not integers, and the transactions holding them are kept as objects
+                integral = np.fromiter((all(isinstance(v, (int, np.integer)) and not isinstance(v, bool) for v in row) 
+                                        for row in values), dtype=bool, count=len(rows))
+                flat = np.asarray(list(itertools.chain.from_iterable(v for v, i in zip(values, integral) if i)), dtype=np.int64)
+
+            size = self._size + len(rows)
+            if size > len(self._records):
+                self._records = np.resize(self._records, max(size, 2 * len(self._records)))
+            payload_size = self._payload_size + len(flat)
+            if payload_size > len(self._payload):
+                self._payload = np.resize(self._payload, max(payload_size, 2 * len(self._payload)))
+
+            records = self._records[self._size:size]
+            records['time'] = times
+            records['kind'] = kinds
+            records['event'] = events
+            records['source'] = [self._name_id(name) for name in sources]
+            records['target'] = [self._name_id(name) for name in targets]
+            payload_counts = np.where(integral, counts, 0)
+            offsets = self._payload_size + np.cumsum(payload_counts) - payload_counts
+            if not integral.all():
+                objects = np.flatnonzero(~integral)
+                offsets[objects] = -1 - (len(self.objects) + np.arange(len(objects)))
+                self.objects.extend(values[i] for i in objects)
+            records['offset'] = offsets
+            records['count'] = counts
+            self._payload[self._payload_size:payload_size] = flat
+
+            self._size = size
+            self._payload_size = payload_size
 
     def record_qtransaction(self, time, event_type, source, target, qubits):
         '''
@@ -17,18 +154,7 @@ class MasterClock:
         :param String target: name of the agent receiving qubits
         :param List<int> qubits: list of qubits being sent from source to target
         '''
-        # Update master clock
-        self.time = max(self.time, time)
-
-        # Record Event
-        if event_type == 'sent':
-            transaction = 'Qubits {} sent from {} to {} at {}'.format(qubits, source, target, time)
-        elif event_type == 'received':
-            transaction = 'Qubits {} received by {} from {} at {}'.format(qubits, target, source, time)
-        else: 
-            raise Exception('Event type must be "sent" or "received"') 
-
-        self.transactions.append(transaction)
+        self._record(time, QUANTUM, event_type, source, target, qubits)
 
     def record_ctransaction(self, time, event_type, source, target, cbits):
             '''
@@ -40,34 +166,64 @@ class MasterClock:
             :param String target: name of the agent receiving cbits
             :param List<int> cbits: list of cbits being sent from source to target
             '''
-            # Update master clock
-            self.time = max(self.time, time)
-
-            # Record Event
-            if event_type == 'sent':
-                transaction = 'Bits {} sent from {} to {} at {}'.format(cbits, source, target, time)
-            elif event_type == 'received':
-                transaction = 'Bits {} received by {} from {} at {}'.format(cbits, target, source, time)
-            else: 
-                raise Exception('Event type must be "sent" or "received"') 
-
-            self.transactions.append(transaction)
+            self._record(time, CLASSICAL, event_type, source, target, cbits)
 
     def get_time(self):
         '''
         :return: master time
         '''
         return self.time
-    
+
+    def to_array(self):
+        '''
+        Structured array of recorded transactions, with fields time, kind, event, source, target,
+        offset and count (see MasterClock). The array is a view of the clock's columns and is not
+        copied; it does not include transactions recorded after it is returned.
+
+        :return: structured NumPy array with one row per transaction
+        '''
+        self._flush()
+        return self._records[:self._size]
+
+    def payload(self):
+        '''
+        Flat array of the qubits and cbits of all transactions, indexed by the offset and count
+        of each transaction (except cbits that are not integers, see MasterClock). The array is a 
+        view and is not copied.
+
+        :return: NumPy array
+        '''
+        self._flush()
+        return self._payload[:self._payload_size]
+
+    def _render(self, record):
+        '''
+        :param record: row of to_array()
+        :return: transaction formatted as a string
+        '''
+        time, kind, event, source, target, offset, count = record.tolist()
+        values = self._payload[offset:offset + count].tolist() if offset >= 0 else list(self.objects[-1 - offset])
+        label = 'Qubits' if kind == QUANTUM else 'Bits'
+        if event == SENT:
+            return '{} {} sent from {} to {} at {}'.format(label, values, self.names[source], self.names[target], time)
+        return '{} {} received by {} from {} at {}'.format(label, values, self.names[target], self.names[source], time)
+
+    @property
+    def transactions(self):
+        '''
+        :return: list of all transactions formatted as strings
+        '''
+        return [self._render(record) for record in self.to_array()]
+
     def recent_transaction(self):
         '''
         Print the most recent transaction
         '''
-        print(self.transactions[-1])
+        print(self._render(self.to_array()[-1]))
 
-    def display_transactions(self): 
+    def display_transactions(self):
         '''
         Prints all transactions
         '''
-        for transaction in self.transactions: 
-            print(transaction)
\ No newline at end of file
+        for record in self.to_array():
+            print(self._render(record))
@@ -2,26 +2,40 @@ import queue
 import multiprocessing
 import itertools
 import sys
+import time
+import numpy as np
 
-__all__ = ["QConnect", "CConnect"]
+from netQuil import noise, profiling
+
+__all__ = ["QConnect", "CConnect", "Pipeline"]
 
 pulse_length_default = 10 * 10 ** -12 # 10 ps photon pulse length
 signal_speed = 2.998 * 10 ** 5 #speed of light in km/s
 fiber_length_default = 0.0
 
 class QConnect: 
-    def __init__(self, *args, transit_devices=[]):
+    def __init__(self, *args, transit_devices=[], attribute_loss=True):
         '''
         This is the base class for a quantum connection between multiple agents. 
 
         :param agents \*args: list of agents to connect
         :param List<Devices> transit_devices: list of devices qubits travel through 
+        :param Boolean attribute_loss: if False, consecutive attenuation-only devices (e.g. a chain of Fibers) are 
+            merged into one effective transmittance and each qubit's loss is sampled once, without recording which 
+            device lost it (see Pipeline)
         '''
         agents = list(args)
         self.agents = {}
         self.source_devices = {}
         self.target_devices = {}
         self.transit_devices = {}
+        self.attribute_loss = attribute_loss
+
+        # Qubits lost by devices during the current trial
+        self.lost_qubits = []
+
+        # Compiled pipelines of each (source, target) route, cleared at the start of each trial
+        self.routes = {}
 
         '''
         Create queue to keep track of multiple requests. Name of queue is name of
@@ -39,122 +53,112 @@ class QConnect:
                 if agentConnect != agent:
                     agent.qconnections[agentConnect.name] = self
 
-    def put(self, source, target, qubits, source_time):
+    def __getstate__(self):
+        '''
+        Connections are pickled with empty queues
+        '''
+        state = self.__dict__.copy()
+        state['queues'] = list(self.queues)
+        state['routes'] = {}
+        return state
+
+    def __setstate__(self, state):
+        state['queues'] = {name: queue.Queue() for name in state['queues']}
+        self.__dict__.update(state)
+
+    def route(self, source, target):
+        '''
+        Returns the pipelines qubits sent from source to target pass through, compiling them on 
+        first use: one for the source's devices, applied when qubits are sent, and one for the 
+        transit and target devices, applied when qubits are received.
+
+        :param String source: name of agent sending qubits
+        :param String target: name of agent receiving qubits
+        :returns: tuple of source pipeline and receive pipeline
+        '''
+        if (source, target) not in self.routes:
+            source_devices = self.source_devices[source]
+            transit_devices = self.transit_devices[source]
+            self.routes[(source, target)] = (
+                Pipeline(source_devices, 0 if source_devices else pulse_length_default, self.attribute_loss),
+                Pipeline(transit_devices + self.target_devices[target], 
+                         0 if transit_devices else fiber_length_default/signal_speed, self.attribute_loss))
+        return self.routes[(source, target)]
+
+    def put(self, source, target, qubits, source_time, logical_time=0):
         ''' 
-        Constructs full list of devices that each qubit must travel through. Sends the qubits
-        through source devices. Places qubits and a list of transit and target 
-        devices on the queue. Queue is keyed on the target agent's name.
+        Sends the qubits through the route's source devices. Places qubits and the route's 
+        pipeline of transit and target devices on the queue. Queue is keyed on the target agent's name.
         
         :param String source: name of agent where the qubits being sent originated
         :param String target: name of agent receiving qubits
         :param Array qubits: array of numbers corresponding to qubits the source is sending 
         :param Float source_time: time of source agent before sending qubits
+        :param Int logical_time: logical time of source agent when sending qubits (see Agent.logical_time)
         :returns: time qubits took to pass through source devices
         '''
-        source_devices = self.source_devices[source]
-        transit_devices = self.transit_devices[source]
-        target_devices = self.target_devices[target]
-
-        non_source_devices = {
-            "transit": transit_devices,
-            "target": target_devices,
-        }
-
+        source_pipeline, receive_pipeline = self.route(source, target)
         program = self.agents[source].program
-        source_delay = 0
-
-        # Keep track of qubits remaining
-        traveling_qubits = qubits
-
-        if not source_devices:
-            source_delay += pulse_length_default
-        else:
-            # Keep track of qubits lost by each device
-            total_lost_qubits = []
-            for device in source_devices:
-                # If qubits are still remaining 
-                if traveling_qubits:
-                    res = device.apply(program, traveling_qubits)
-                    if 'lost_qubits' in res.keys(): 
-                        lost_qubits = res['lost_qubits']
-                        # Remove lost qubits from traveling qubits
-                        traveling_qubits = list(set(traveling_qubits) - set(lost_qubits))
-                        # Add lost_qubits lost from current device to total_lost_qubits
-                        total_lost_qubits += lost_qubits
-                    if 'delay' in res.keys(): source_delay += res['delay']
-
-                else: break
-
-            # Invert lost qubits and add to traveling qubits
-            for q in total_lost_qubits: 
-                if q == 0: total_lost_qubits.append(float("-inf"))
-                else: total_lost_qubits.append(-q)
-            traveling_qubits += total_lost_qubits
+
+        # Keep track of qubits remaining and lost
+        traveling_qubits, lost_qubits, source_delay = source_pipeline.apply(program, list(qubits))
+        self.lost_qubits.extend(lost_qubits)
 
         # Scale source delay time according to number of qubits sent
         scaled_source_delay = source_delay*len(qubits) 
 
-        self.queues[target].put((traveling_qubits, non_source_devices, scaled_source_delay, source_time))
+        self.queues[target].put_nowait((traveling_qubits, lost_qubits, receive_pipeline, scaled_source_delay, source_time, logical_time))
         return scaled_source_delay
 
     def get(self, agent): 
         '''
         Pops qubits off of the agent's queue. Sends qubit through transit and target devices,
         simulating a quantum network. Return an array of the qubits that have been altered, as well as
-        the time it took the qubit to travel through the network. Some qubits may be lost during transmission. If lost,
-        their value will switch to negative, or, in the case of 0, be set to -inf
+        the time it took the qubit to travel through the network. Some qubits may be lost during transmission. Lost
+        qubits are returned separately, and recorded as lost in the agent's qubit register
+
+        :param Agent agent: agent receiving the qubits 
+        :returns: list of qubits, list of lost qubits, time to pass through transit and target devices, and the source agent's time
+        '''
+        return self._receive(agent, _timed_get(self.queues[agent.name], agent.name, 'quantum'))
+
+    async def aget(self, agent):
+        '''
+        Awaitable version of get, for connections whose queues are asyncio queues (see AsyncSimulation)
+
+        :param AsyncAgent agent: agent receiving the qubits 
+        :returns: list of qubits, list of lost qubits, time to pass through transit and target devices, and the source agent's time
+        '''
+        return self._receive(agent, await _timed_aget(self.queues[agent.name], agent.name, 'quantum'))
+
+    def _receive(self, agent, item):
+        '''
+        Sends qubits popped off of the agent's queue through transit and target devices
 
         :param Agent agent: agent receiving the qubits 
-        :returns: list of qubits, time to pass through transit and target devices, and the source agent's time
+        :param Tuple item: qubits, lost qubits, pipeline, source delay, source time and logical time placed on the queue by put
+        :returns: list of qubits, list of lost qubits, time to pass through transit and target devices, and the source agent's time
         '''
-        traveling_qubits, devices, source_delay, source_time = self.queues[agent.name].get()
+        traveling_qubits, lost_qubits, pipeline, source_delay, source_time, logical_time = item
 
-        agent.qubits = list(set(traveling_qubits + agent.qubits))
+        # Instructions the agent adds from now on (including those of its devices) follow the source's
+        agent.logical_time = max(agent.logical_time, logical_time + 1)
+        agent.qubits.update(traveling_qubits)
 
         program = self.agents[agent.name].program
-       
-        transit_devices = devices["transit"]
-        target_devices = devices["target"]
 
         # Number of qubits before any are lost 
-        num_travel_qubits = len(traveling_qubits)
-        travel_delay = 0
+        num_travel_qubits = len(traveling_qubits) + len(lost_qubits)
 
-        if not transit_devices:
-            travel_delay += fiber_length_default/signal_speed
-        if not target_devices:
-            travel_delay += 0
-        
-        total_lost_qubits = [q for q in traveling_qubits if q < 0 or q == float("-inf")] 
-        remaining_qubits = [q for q in traveling_qubits if q >= 0]
-
-        for device in list(itertools.chain(transit_devices, target_devices)):
-            # If qubits are remaining 
-            if remaining_qubits: 
-                res = device.apply(program, traveling_qubits)
-                if 'lost_qubits' in res.keys(): 
-                    lost_qubits = res['lost_qubits']
-                    # Remove lost qubits from traveling qubits
-                    remaining_qubits = list(set(remaining_qubits) - set(lost_qubits))
-                    # Add lost_qubits lost from current device to total_lost_qubits
-                    total_lost_qubits += lost_qubits
-                if 'delay' in res.keys(): travel_delay += res['delay']
-            else: break
-
-        # Remove traveling_qubits
-        agent.qubits = list(set(agent.qubits) - set(traveling_qubits))   
-
-        lost_qubits_flipped = []
-        for q in total_lost_qubits: 
-            if q == 0: lost_qubits_flipped.append(float("-inf"))
-            else:
-                lost_qubits_flipped.append(-q)
+        traveling_qubits, transit_lost_qubits, travel_delay = pipeline.apply(program, traveling_qubits)
+        self.lost_qubits.extend(transit_lost_qubits)
+
+        # Record qubits lost at the source and in transit as lost by the agent
+        lost_qubits = lost_qubits + transit_lost_qubits
+        agent.qubits.lose(lost_qubits)
 
-        # Add inverted lost qubits to remaining qubits
-        traveling_qubits = remaining_qubits + lost_qubits_flipped
-        agent.qubits += traveling_qubits
         scaled_delay = travel_delay*num_travel_qubits + source_delay
-        return traveling_qubits, scaled_delay, source_time
+        return traveling_qubits, lost_qubits, scaled_delay, source_time
 
 class CConnect: 
     def __init__(self, *args, length=0.0):
@@ -183,16 +187,29 @@ class CConnect:
 
         self.length = length
 
-    def put(self, target, cbits):
+    def __getstate__(self):
+        '''
+        Connections are pickled with empty queues
+        '''
+        state = self.__dict__.copy()
+        state['queues'] = list(self.queues)
+        return state
+
+    def __setstate__(self, state):
+        state['queues'] = {name: queue.Queue() for name in state['queues']}
+        self.__dict__.update(state)
+
+    def put(self, target, cbits, logical_time=0):
         ''' 
         Places cbits on queue keyed on the target Agent's name
 
         :param String target: name of recipient of program
         :param Array cbits: array of numbers corresponding to cbits agent is sending
+        :param Int logical_time: logical time of agent sending cbits (see Agent.logical_time)
         :returns: time for cbits to travel
         '''
         csource_delay = pulse_length_default * 8 * sys.getsizeof(cbits)
-        self.queues[target].put((cbits, csource_delay))
+        self.queues[target].put_nowait((cbits, csource_delay, logical_time))
         return csource_delay
 
     def get(self, agent): 
@@ -202,9 +219,221 @@ class CConnect:
         :param String agent: name of the agent receiving the cbits
         :returns: cbits from source and time they took to travel
         '''
-        cbits, source_delay = self.queues[agent].get()
+        return self._receive(agent, _timed_get(self.queues[agent], agent, 'classical'))
+
+    async def aget(self, agent): 
+        '''
+        Awaitable version of get, for connections whose queues are asyncio queues (see AsyncSimulation)
+
+        :param String agent: name of the agent receiving the cbits
+        :returns: cbits from source and time they took to travel
+        '''
+        return self._receive(agent, await _timed_aget(self.queues[agent], agent, 'classical'))
+
+    def _receive(self, agent, item):
+        '''
+        Adds travel delay to cbits popped off of an agent's queue
+
+        :param String agent: name of the agent receiving the cbits
+        :param Tuple item: cbits, source delay and logical time placed on the queue by put
+        :returns: cbits from source and time they took to travel
+        '''
+        cbits, source_delay, logical_time = item
+
+        # Instructions the agent adds from now on follow the sender's
+        receiver = self.agents[agent]
+        receiver.logical_time = max(receiver.logical_time, logical_time + 1)
         travel_delay = self.length/signal_speed
         
         scaled_delay = travel_delay*len(cbits) + source_delay
 
-        return cbits, scaled_delay
\ No newline at end of file
+        return cbits, scaled_delay
+
+class Pipeline:
+    def __init__(self, devices, default_delay=0, attribute_loss=True):
+        '''
+        Devices qubits pass through on part of a route, compiled into stages. Consecutive devices
+        with a fixed delay that lose each qubit independently with a fixed probability (see 
+        Device.transmission, e.g. Fiber) are fused into a single stage that draws where each qubit 
+        is lost in one call. Every other device is a stage of its own, applied with apply_batch.
+
+        Without loss attribution, fused devices are treated as a single device: each qubit is lost with 
+        one minus the product of their transmission probabilities, the stage always takes the sum of their
+        delays, lost qubits are measured into the register of the first lossy device, and the trials and 
+        successes of the devices are not counted.
+
+        The noise models of the devices in a stage (see Device.noise_model) are composed into one 
+        NoiseModel, applied to the qubits passing through the whole stage as a single noisy gate per qubit.
+
+        :param List<Device> devices: devices in the order qubits pass through them
+        :param Float default_delay: delay if qubits pass through no devices
+        :param Boolean attribute_loss: record which of the fused devices lost each qubit
+        '''
+        self.devices = list(devices)
+        self.default_delay = default_delay
+        self.attribute_loss = attribute_loss
+        self.stages = []
+        self.noise_models = []
+
+        fused = []
+        for device in self.devices + [None]:
+            transmission = device.transmission() if device is not None else None
+            if transmission is not None:
+                fused.append((device,) + tuple(transmission))
+                continue
+            if fused:
+                self._add_stage(_FusedStage(fused, attribute_loss), [d for d, _, _ in fused])
+                fused = []
+            if device is not None:
+                self._add_stage(device, [device])
+
+        # Delay every qubit passing through the pipeline takes, whichever devices lose qubits: the delays
+        # of fused stages up to the first device that may lose qubits or whose delay is only known once applied
+        self.delay = self.default_delay
+        for stage in self.stages:
+            if not isinstance(stage, _FusedStage):
+                break
+            self.delay += stage.min_delay
+            if stage.min_delay != stage.delays[-1]:
+                break
+
+    def _add_stage(self, stage, devices):
+        '''
+        :param Device|_FusedStage stage: stage to add
+        :param List<Device> devices: devices of the stage, whose noise models are composed
+        '''
+        models = [d.noise_model for d in devices if getattr(d, 'noise_model', None) is not None]
+        self.stages.append(stage)
+        self.noise_models.append(models[0].compose(*models[1:]) if models else None)
+
+    def apply(self, program, qubits):
+        '''
+        Send qubits through each stage of the pipeline, stopping once every qubit is lost
+
+        :param Program program: program devices are applied to
+        :param List<int> qubits: qubits passing through the pipeline
+        :returns: qubits remaining, qubits lost, and time qubits took to pass through the devices
+        '''
+        delay = self.default_delay
+        lost_qubits = []
+        profiler = profiling.profiler
+        for stage, noise_model in zip(self.stages, self.noise_models):
+            # If qubits are still remaining
+            if not qubits:
+                break
+            if profiler is not None:
+                start = time.perf_counter()
+                res = stage.apply_batch(program, qubits)
+                profiler.record_device(getattr(stage, 'name', type(stage).__name__), len(qubits), time.perf_counter() - start)
+            else:
+                res = stage.apply_batch(program, qubits)
+            # Remove qubits lost by current stage from traveling qubits
+            qubits, lost = _split_lost(qubits, res['lost'])
+            lost_qubits += lost
+            delay += res['delay']
+            if noise_model is not None:
+                noise_model.apply(program, qubits)
+        return qubits, lost_qubits, delay
+
+class _FusedStage:
+    def __init__(self, devices, attribute_loss=True):
+        '''
+        Consecutive devices that delay qubits by a fixed time and lose each qubit with a fixed 
+        probability. Whether and where each qubit is lost is drawn in one call: a qubit passes 
+        the first j lossy devices if a uniform draw is below the probability of passing all of them.
+        Without loss attribution only whether each qubit passes every device is drawn.
+
+        :param List devices: tuples of device, delay and probability each qubit is transmitted (None if never lost)
+        :param Boolean attribute_loss: record which device lost each qubit
+        '''
+        self.attribute_loss = attribute_loss
+        self.devices = [device for device, _, _ in devices]
+        # Devices subclassing Device without calling Device.__init__ are named after their class
+        self.names = [getattr(device, 'name', type(device).__name__) for device in self.devices]
+        self.name = '+'.join(self.names)
+        self.lossy = [i for i, (_, _, prob) in enumerate(devices) if prob is not None]
+        self.survival = np.cumprod([devices[i][2] for i in self.lossy])
+        self.delays = np.cumsum([delay for _, delay, _ in devices])
+        # Delay of the stage when every qubit is lost by its first lossy device, as devices after it are not passed through
+        self.min_delay = self.delays[self.lossy[0]] if self.lossy and attribute_loss else self.delays[-1]
+
+    def apply_batch(self, program, qubits):
+        '''
+        Send qubits through the devices, measuring lost qubits into the register of the device losing them
+
+        :param Program program: program devices are applied to
+        :param List<int> qubits: qubits passing through the devices
+        :return: dictionary of delay and boolean array lost, True for each qubit lost
+        '''
+        n, m = len(qubits), len(self.lossy)
+        if not m:
+            return {'delay': self.delays[-1], 'lost': np.zeros(n, dtype=bool)}
+
+        # Outcomes of the stage are drawn with the generator of its first lossy device
+        rng = noise.generator(self.devices[self.lossy[0]])
+
+        if not self.attribute_loss:
+            lost = np.asarray(noise.sample("loss", tuple(qubits), 
+                lambda trials: rng.random((trials, n)) > self.survival[-1]))
+            name = self.names[self.lossy[0]]
+            for idx in np.flatnonzero(lost):
+                noise._readout(program, qubits[idx], name)
+            return {'delay': self.delays[-1], 'lost': lost}
+
+        passed = np.asarray(noise.sample("loss", tuple(qubits), 
+            lambda trials: np.searchsorted(-self.survival, -rng.random((trials, n)), side='right')))
+        lost = passed < m
+
+        # Count the qubits reaching and passing each lossy device
+        counts = np.bincount(passed, minlength=m + 1)
+        reached = n - np.concatenate(([0], np.cumsum(counts)[:-2]))
+        for j, i in enumerate(self.lossy):
+            device = self.devices[i]
+            device.trials += int(reached[j])
+            device.success += int(reached[j] - counts[j])
+
+        for idx in np.flatnonzero(lost):
+            noise._readout(program, qubits[idx], self.names[self.lossy[passed[idx]]])
+
+        # Devices after the last device any qubit reached are not passed through
+        farthest = len(self.devices) - 1 if counts[m] else self.lossy[int(passed.max())]
+        return {'delay': self.delays[farthest], 'lost': lost}
+
+def _timed_get(agent_queue, name, kind):
+    '''
+    Pop an item off of a queue, recording how long the agent was blocked when profiling
+
+    :param Queue agent_queue: queue of the agent
+    :param String name: name of the agent receiving
+    :param String kind: quantum or classical
+    :returns: item
+    '''
+    profiler = profiling.profiler
+    if profiler is None:
+        return agent_queue.get()
+    start = time.perf_counter()
+    item = agent_queue.get()
+    profiler.record_wait(name, kind, time.perf_counter() - start)
+    return item
+
+async def _timed_aget(agent_queue, name, kind):
+    '''
+    Awaitable version of _timed_get, for asyncio queues and mailboxes
+    '''
+    profiler = profiling.profiler
+    if profiler is None:
+        return await agent_queue.get()
+    start = time.perf_counter()
+    item = await agent_queue.get()
+    profiler.record_wait(name, kind, time.perf_counter() - start)
+    return item
+
+def _split_lost(qubits, lost):
+    '''
+    :param List<int> qubits: qubits passing through a device
+    :param Array lost: boolean array, True for each qubit lost by the device
+    :returns: qubits remaining and qubits lost, in order
+    '''
+    if not lost.any():
+        return qubits, []
+    return list(itertools.compress(qubits, ~lost)), list(itertools.compress(qubits, lost))
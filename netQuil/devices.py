@@ -17,6 +17,10 @@ class Device():
         self.name = 'Device'
         self.success = 0
         self.trials = 0
+        # Random number generator of the device, replaced with a seeded generator each trial (see Simulation.run)
+        self.rng = np.random.default_rng()
+        # NoiseModel applied to every qubit passing through the device (see Pipeline)
+        self.noise_model = None
     
     def apply(self, program, qubits):
         '''
@@ -28,11 +32,49 @@ class Device():
         '''
         return {delay: None, qubits: None}
 
+    def apply_batch(self, program, qubits):
+        '''
+        Applies device to a batch of qubits at once, returning which of them were lost as a 
+        boolean array. Defaults to calling apply. Devices drawing random outcomes (e.g. Fiber 
+        and Laser) override it to draw the outcomes of every qubit in a single call.
+
+        :param Pyquil<Program> program: program to manipulate
+        :param List<int> qubits: list of qubits passing through device
+        :return: dictionary of delay and boolean array lost, True for each qubit lost
+        '''
+        res = self.apply(program, qubits)
+        lost_qubits = set(res.get('lost_qubits', []))
+        return {
+            'delay': res.get('delay', 0),
+            'lost': np.array([q in lost_qubits for q in qubits], dtype=bool)
+        }
+
+    def transmission(self):
+        '''
+        Devices that delay every qubit by a fixed time and lose each qubit independently with a
+        fixed probability, without otherwise changing the program (except for their noise_model), return their delay and the 
+        probability a qubit is transmitted (None if qubits are never lost). Consecutive such 
+        devices on a route are fused into a single step (see Pipeline). Lost qubits are measured
+        into the register named after the device, which counts its trials and successes.
+        Other devices return None and are applied with apply_batch.
+
+        :return: tuple of delay and probability, or None
+        '''
+        return None
+
     def get_results(self):
         '''
         Prints device information about trial to console. 
         '''
         pass
+
+    def get_stats(self):
+        '''
+        Returns device information about trial, e.g. number of successes and trials
+
+        :return: dictionary of statistics
+        '''
+        return {'success': getattr(self, 'success', 0), 'trials': getattr(self, 'trials', 0)}
     
     def reset(self): 
         '''
@@ -41,14 +83,18 @@ class Device():
         pass 
 
 class Fiber(Device):
-    def __init__(self, length=0.0, attenuation_coefficient = -0.16, apply_error=True):
+    def __init__(self, length=0.0, attenuation_coefficient = -0.16, apply_error=True, noise_model=None):
         '''
         Simulation of fiber optics with given length and attenuation coefficient. 
 
         :param Float length: length of fiber optical cable in km
         :param Float attenuation_coefficient: coefficient determining likelihood of photon loss
         :param Boolean apply_error: True is device should apply error, otherwise, only returns time delay
+        :param NoiseModel noise_model: noise applied to qubits passing through the fiber
         '''
+        Device.__init__(self)
+        self.noise_model = noise_model
+        self.name = 'Fiber'
         decibel_loss = length*attenuation_coefficient
         self.attenuation = 10 ** (decibel_loss / 10)
         self.apply_error = apply_error
@@ -62,28 +108,61 @@ class Fiber(Device):
         :param List<int> qubits: qubits being sent
         :return: time qubits took to travel through fiber
         '''
-        lost_qubits = []
-        for i, qubit in enumerate(qubits):
-            if qubit < 0: continue
+        res = self._apply_batch(program, qubits)
+        return {
+            'delay': res['delay'], 
+            'lost_qubits': [q for q, lost in zip(qubits, res['lost']) if lost]
+        }
 
-            if self.apply_error:
-                q = noise.measure(program, qubit, self.attenuation, "Fiber")
-                if q is not None: 
-                    lost_qubits.append(q)
-                
-        delay = self.length/signal_speed
+    def apply_batch(self, program, qubits):
+        '''
+        Applies device's error to all qubits at once, drawing whether each qubit is lost in a single call.
+        Subclasses overriding apply are applied with Device.apply_batch.
+
+        :param Program program: program to be modified
+        :param List<int> qubits: qubits being sent
+        :return: dictionary of delay and boolean array lost, True for each qubit lost
+        '''
+        if type(self).apply is not Fiber.apply:
+            return Device.apply_batch(self, program, qubits)
+        return self._apply_batch(program, qubits)
+
+    def _apply_batch(self, program, qubits):
+        lost = np.zeros(len(qubits), dtype=bool)
+        if self.apply_error:
+            lost = noise.measure_batch(program, qubits, self.attenuation, "Fiber", noise.generator(self))
+            self.trials += len(qubits)
+            self.success += len(qubits) - int(np.count_nonzero(lost))
 
         return {
-            'delay': delay, 
-            'lost_qubits': lost_qubits
+            'delay': self.length/signal_speed, 
+            'lost': lost
         }
 
+    def transmission(self):
+        '''
+        Fibers delay qubits by the time light takes to travel their length, and lose each qubit 
+        with probability 1 - attenuation (see Device.transmission)
+
+        :return: tuple of delay and probability, or None if apply is overridden
+        '''
+        if type(self).apply is not Fiber.apply or type(self).apply_batch is not Fiber.apply_batch:
+            return None
+        return (self.length/signal_speed, self.attenuation if self.apply_error else None)
+
+    def reset(self):
+        self.success = 0
+        self.trials = 0
+
 class Laser(Device):
-    def __init__(self, pulse_length=10 * 10 ** -12, expected_photons=1.0, rotation_prob_variance=1.0, wavelength=1550, apply_error=True):
+    def __init__(self, pulse_length=10 * 10 ** -12, expected_photons=1.0, rotation_prob_variance=1.0, wavelength=1550, apply_error=True, noise_model=None):
         '''
         Simulation of laser at 1550nm wavelength. Laser produce photons according to poisson
         distribution, centered around expected_photons. 
+
+        :param NoiseModel noise_model: noise applied to qubits passing through the laser
         '''
+        self.noise_model = noise_model
         self.variance = rotation_prob_variance
         self.wavelength = wavelength
         self.photon_expectation = expected_photons
@@ -92,6 +171,7 @@ class Laser(Device):
         self.name = 'Laser'
         self.success = 0
         self.trials = 0
+        self.rng = np.random.default_rng()
         
     def apply(self, program, qubits):
         '''
@@ -100,22 +180,49 @@ class Laser(Device):
         :param List<int> qubits: list of qubits going through laser
         :return: time it took qubits to pass through device
         '''
-        for qubit in qubits:
-            if qubit < 0: continue
+        return {
+            'delay': self._apply_batch(program, qubits)['delay']
+        }
+
+    def apply_batch(self, program, qubits):
+        '''
+        Applies laser effect to all qubits at once, drawing the photon counts of every qubit in a single call.
+        Subclasses overriding apply are applied with Device.apply_batch.
+        :param Program program: global program
+        :param List<int> qubits: list of qubits going through laser
+        :return: dictionary of delay and boolean array lost (lasers do not lose qubits)
+        '''
+        if type(self).apply is not Laser.apply:
+            return Device.apply_batch(self, program, qubits)
+        return self._apply_batch(program, qubits)
 
-            if self.apply_error:
-                numPhotons = np.random.poisson(lam=self.photon_expectation)
-                self.trials += len(qubits)
-                if numPhotons == self.photon_expectation: self.success += 1
-                '''
-                Rotation Noise
+    def _apply_batch(self, program, qubits):
+        if self.apply_error and len(qubits):
+            rng = noise.generator(self)
+            numPhotons = noise.tally("photons", tuple(qubits), 
+                lambda trials: rng.poisson(lam=self.photon_expectation, size=(trials, len(qubits))))
+            self.trials += numPhotons.size
+            self.success += int(np.count_nonzero(numPhotons == self.photon_expectation))
+            '''
+            Rotation Noise
+            for qubit in qubits:
                 noise.normal_unitary_rotation(program, qubit, 0.5, self.variance)
-                '''
-        delay = self.pulse_length
+            '''
         return {
-            'delay': delay
+            'delay': self.pulse_length,
+            'lost': np.zeros(len(qubits), dtype=bool)
         }
 
+    def transmission(self):
+        '''
+        Lasers without error only delay qubits by their pulse length (see Device.transmission)
+
+        :return: tuple of delay and probability, or None if the laser applies error
+        '''
+        if self.apply_error or type(self).apply is not Laser.apply or type(self).apply_batch is not Laser.apply_batch:
+            return None
+        return (self.pulse_length, None)
+
     def get_results(self):
         try: 
             print('{} has a signal to noise ratio of {}/{}'.format(self.name, self.success, self.trials))
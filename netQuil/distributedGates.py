@@ -59,7 +59,7 @@ def cat_entangler(control, targets, entangled=False, notify=False):
     # Collect all qubits except control bit
     qubits = [measure_qubit] + [q[1] for q in targets]
 
-    # Tell Tracer to Ignore Operations
+    # Skip Ownership Checks of Operations
     distributed_gate([agent] + [t[0] for t in targets])
 
     # If qubits are not already entangled, and distribute all non-control qubits
@@ -83,7 +83,7 @@ def cat_entangler(control, targets, entangled=False, notify=False):
     for q in qubits:
         p.if_then(ro[measure_qubit], X(q))
 
-    # Tell Tracer We're Done
+    # Resume Ownership Checks
     distributed_gate([agent] + [t[0] for t in targets])
     if notify: notify_entangler_is_done(caller=agent, target_agents=[t[0] for t in targets])
 
@@ -104,7 +104,7 @@ def cat_disentangler(control, targets, notify=False):
     agent, psi, ro = control
     p = agent.program
 
-    # Tell Tracer to Ignore Operations
+    # Skip Ownership Checks of Operations
     distributed_gate([agent] + [t[0] for t in targets])
 
     # Perform Hadamard of each qubit
@@ -127,7 +127,7 @@ def cat_disentangler(control, targets, notify=False):
 
     p.if_then(ro[targets[0][1]], Z(psi))
 
-    # Tell Tracer We're Done
+    # Resume Ownership Checks
     distributed_gate([agent] + [t[0] for t in targets])
     if notify: notify_entangler_is_done(caller=agent, target_agents=[t[0] for t in targets])
 
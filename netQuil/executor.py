@@ -0,0 +1,511 @@
+import abc
+import numpy as np
+
+from pyquil.quilatom import MemoryReference, Label, LabelPlaceholder
+from pyquil.quilbase import (Gate, Measurement, Declare, Pragma, Jump, JumpWhen, JumpUnless,
+                             JumpTarget, Halt, Reset, ResetQubit, ClassicalExclusiveOr,
+                             ClassicalInclusiveOr, ClassicalAnd, ClassicalNot, ClassicalMove)
+
+try:
+    from pyquil.simulation.matrices import QUANTUM_GATES
+except ImportError:
+    from pyquil.gate_matrices import QUANTUM_GATES
+
+__all__ = ["DensityMatrixSimulator", "TrajectorySimulator"]
+
+# Upper bound, in bytes, on the states held in memory at once for a single batch of trials
+batch_memory_default = 2 ** 28
+
+def parse_kraus_pragma(pragma):
+    '''
+    Recover the Kraus operator encoded in a ``PRAGMA ADD-KRAUS`` instruction, as emitted
+    by ``Program.define_noisy_gate``
+
+    :param Pragma pragma: ADD-KRAUS pragma
+    :return: gate name, tuple of qubits and Kraus matrix
+    '''
+    name = pragma.args[0]
+    qubits = tuple(_index(q) for q in pragma.args[1:])
+    entries = [complex(e.replace('i', 'j')) for e in pragma.freeform_string.strip('()').split()]
+    dim = 2 ** len(qubits)
+    return name, qubits, np.asarray(entries, dtype=np.complex128).reshape(dim, dim)
+
+def _index(qubit):
+    '''
+    :param Qubit|int qubit: pyquil qubit or integer index
+    :return: integer index of qubit
+    '''
+    return qubit if isinstance(qubit, int) else qubit.index
+
+def _label(target):
+    '''
+    :param Label target: label of a jump or jump target
+    :return: name of label
+    '''
+    if isinstance(target, (Label, LabelPlaceholder)):
+        return target.name
+    return str(target)
+
+def _address(reference):
+    '''
+    :param MemoryReference reference: reference into classical memory
+    :return: tuple of register name and offset
+    '''
+    return reference.name, reference.offset
+
+def gate_matrix(gate, defined_gates):
+    '''
+    Unitary of a gate, including DAGGER and CONTROLLED modifiers. The matrix is ordered
+    by the gate's qubits, with the first qubit being the most significant.
+
+    :param Gate gate: pyquil gate
+    :param Dict defined_gates: DEFGATE matrices keyed on gate name
+    :return: unitary matrix
+    '''
+    if gate.name in defined_gates:
+        matrix = defined_gates[gate.name]
+    elif gate.name in QUANTUM_GATES:
+        matrix = QUANTUM_GATES[gate.name]
+        if gate.params:
+            if any(isinstance(p, MemoryReference) for p in gate.params):
+                raise Exception('Gate {} has parameters read from classical memory'.format(gate.name))
+            matrix = matrix(*gate.params)
+    else:
+        raise Exception('Gate {} is not defined'.format(gate.name))
+    matrix = np.asarray(matrix, dtype=np.complex128)
+
+    for modifier in gate.modifiers:
+        if modifier == 'DAGGER':
+            matrix = matrix.conj().T
+        elif modifier == 'CONTROLLED':
+            dim = matrix.shape[0]
+            controlled = np.eye(2 * dim, dtype=np.complex128)
+            controlled[dim:, dim:] = matrix
+            matrix = controlled
+        else:
+            raise Exception('Gate modifier {} is not supported'.format(modifier))
+    return matrix
+
+def compile_program(program):
+    '''
+    Lower a pyquil program into a flat list of operations. Qubits are replaced by their
+    tensor axis, labels by instruction indices, and gates overloaded by ``define_noisy_gate``
+    by their Kraus maps.
+
+    :param Program program: program to compile
+    :return: list of operations, list of qubits (ordered by axis), and dictionary of declarations
+    '''
+    instructions = program.instructions
+    defined_gates = {}
+    for definition in program.defined_gates:
+        if definition.parameters:
+            raise Exception('Parametric DEFGATE {} is not supported'.format(definition.name))
+        defined_gates[definition.name] = np.asarray(definition.matrix, dtype=np.complex128)
+
+    # Collect Kraus maps, declarations, qubits and labels before lowering
+    kraus_maps = {}
+    declarations = {}
+    qubits = set()
+    labels = {}
+    pc = 0
+    for inst in instructions:
+        if isinstance(inst, Pragma) and inst.command == 'ADD-KRAUS':
+            name, kraus_qubits, op = parse_kraus_pragma(inst)
+            kraus_maps.setdefault((name, kraus_qubits), []).append(op)
+            qubits.update(kraus_qubits)
+        elif isinstance(inst, Declare):
+            declarations[inst.name] = (inst.memory_type, inst.memory_size)
+        elif isinstance(inst, Gate):
+            qubits.update(_index(q) for q in inst.qubits)
+        elif isinstance(inst, (Measurement, ResetQubit)):
+            qubits.add(_index(inst.qubit))
+        elif isinstance(inst, JumpTarget):
+            labels[_label(inst.label)] = pc
+            continue
+        pc += 1 if not isinstance(inst, (Pragma, Declare)) else 0
+
+    qubits = sorted(qubits)
+    axis = {q: i for i, q in enumerate(qubits)}
+
+    operations = []
+    for inst in instructions:
+        if isinstance(inst, Gate):
+            gate_qubits = tuple(_index(q) for q in inst.qubits)
+            axes = tuple(axis[q] for q in gate_qubits)
+            if (inst.name, gate_qubits) in kraus_maps and not inst.params and not inst.modifiers:
+                operations.append(('kraus', np.stack(kraus_maps[(inst.name, gate_qubits)]), axes))
+            else:
+                operations.append(('gate', gate_matrix(inst, defined_gates), axes))
+        elif isinstance(inst, Measurement):
+            target = _address(inst.classical_reg) if inst.classical_reg is not None else None
+            operations.append(('measure', axis[_index(inst.qubit)], target))
+        elif isinstance(inst, ResetQubit):
+            operations.append(('reset', axis[_index(inst.qubit)]))
+        elif isinstance(inst, Reset):
+            operations.append(('reset', None))
+        elif isinstance(inst, JumpWhen):
+            operations.append(('jump-when', labels[_label(inst.target)], _address(inst.condition)))
+        elif isinstance(inst, JumpUnless):
+            operations.append(('jump-unless', labels[_label(inst.target)], _address(inst.condition)))
+        elif isinstance(inst, Jump):
+            operations.append(('jump', labels[_label(inst.target)]))
+        elif isinstance(inst, Halt):
+            operations.append(('halt',))
+        elif isinstance(inst, (ClassicalExclusiveOr, ClassicalInclusiveOr, ClassicalAnd, ClassicalMove)):
+            right = _address(inst.right) if isinstance(inst.right, MemoryReference) else int(inst.right)
+            op = {ClassicalExclusiveOr: 'xor', ClassicalInclusiveOr: 'ior',
+                  ClassicalAnd: 'and', ClassicalMove: 'move'}[type(inst)]
+            operations.append((op, _address(inst.left), right))
+        elif isinstance(inst, ClassicalNot):
+            operations.append(('not', _address(inst.target)))
+        elif isinstance(inst, (Pragma, Declare, JumpTarget)):
+            continue
+        else:
+            raise Exception('Instruction {} is not supported'.format(inst))
+
+    return operations, qubits, declarations
+
+class Executor(abc.ABC):
+    '''
+    Base class for netQuil's native executors, which run programs and return the classical memory
+    of every trial (see Executor.execute), e.g. NativeSimulator. Most executors run programs as a 
+    batch of states (see BatchExecutor).
+    '''
+    def __init__(self, seed=None, batch_memory=batch_memory_default):
+        '''
+        :param Int seed: seed of the executor's random number generator
+        :param Int batch_memory: maximum bytes of state held in memory at once
+        '''
+        self.rng = np.random.default_rng(seed)
+        self.batch_memory = batch_memory
+
+    def run(self, program, classical_addresses=None, trials=1):
+        '''
+        Run program and return the contents of the ``ro`` register, mirroring ``QVMConnection.run``
+
+        :param Program program: program to run
+        :param List<int> classical_addresses: offsets of ro to return, defaults to the entire register
+        :param Int trials: number of times to run the program
+        :return: list of lists of bits, one for each trial
+        '''
+        memory = self.execute(program, trials)
+        if 'ro' not in memory:
+            return [[] for _ in range(trials)]
+        ro = memory['ro']
+        if classical_addresses is not None:
+            ro = ro[:, list(classical_addresses)]
+        return ro.tolist()
+
+    @abc.abstractmethod
+    def execute(self, program, trials=1):
+        '''
+        Run program and return the classical memory of every trial
+
+        :param Program program: program to run
+        :param Int trials: number of times to run the program
+        :return: dictionary of arrays keyed on register name, each with one row per trial
+        '''
+
+class BatchExecutor(Executor):
+    '''
+    Executor lowering a program with ``compile_program`` and running every trial at once, keeping
+    a batch of states whose first axis indexes the trials.
+    Trials only diverge after a measurement, so states are shared across the batch until the
+    first measurement is performed (or the first noisy gate, for executors sampling Kraus operators). Trials taking different classical branches are grouped by
+    program counter, and each group is advanced with a single batched operation.
+
+    Children classes define the state representation by overriding ``_init_state``, ``_apply_gate``,
+    ``_apply_kraus``, ``_measure`` and ``_state_size``, and cannot be created until they do.
+    '''
+    # Whether _apply_kraus samples a Kraus operator for each trial, in which case states are no 
+    # longer shared by the batch once a noisy gate is applied
+    samples_kraus = False
+
+    def execute(self, program, trials=1):
+        '''
+        Run program and return the classical memory of every trial
+
+        :param Program program: program to run
+        :param Int trials: number of times to run the program
+        :return: dictionary of arrays keyed on register name, each with one row per trial
+        '''
+        return self._execute_compiled(*compile_program(program), trials)
+
+    def _execute_compiled(self, operations, qubits, declarations, trials=1):
+        '''
+        Run a compiled program in batches that fit in batch_memory
+
+        :param List operations: operations from compile_program
+        :param List<int> qubits: qubits of program
+        :param Dict declarations: declared classical memory
+        :param Int trials: number of times to run the program
+        :return: dictionary of arrays keyed on register name, each with one row per trial
+        '''
+        batch_size = max(1, min(trials, self.batch_memory // max(1, self._state_size(len(qubits)))))
+
+        batches = []
+        for start in range(0, trials, batch_size):
+            batch = min(batch_size, trials - start)
+            batches.append(self._execute(operations, len(qubits), declarations, batch))
+        return {name: np.concatenate([b[name] for b in batches]) for name in declarations}
+
+    def _execute(self, operations, num_qubits, declarations, batch):
+        '''
+        Run one batch of trials
+
+        :param List operations: operations from compile_program
+        :param Int num_qubits: number of qubits in program
+        :param Dict declarations: declared classical memory
+        :param Int batch: number of trials in batch
+        :return: dictionary of classical memory keyed on register name
+        '''
+        memory = {}
+        for name, (memory_type, size) in declarations.items():
+            dtype = np.float64 if memory_type == 'REAL' else np.int64
+            memory[name] = np.zeros((batch, size), dtype=dtype)
+
+        # State is shared by all trials (leading dimension of one) until first measurement
+        state = self._init_state(num_qubits, 1)
+        everyone = np.arange(batch)
+        groups = {0: everyone}
+
+        while groups:
+            pc = min(groups)
+            trials = groups.pop(pc)
+            if pc >= len(operations):
+                continue
+
+            shared = state.shape[0] == 1
+            full = shared or len(trials) == state.shape[0]
+            op = operations[pc]
+            kind = op[0]
+            next_pc = np.full(len(trials), pc + 1)
+
+            if kind in ('gate', 'kraus', 'measure', 'reset'):
+                if (kind in ('measure', 'reset') or (kind == 'kraus' and self.samples_kraus)) and shared and batch > 1:
+                    state = np.repeat(state, batch, axis=0)
+                    shared, full = False, len(trials) == batch
+                sub_state = state if full else state[trials]
+
+                if kind == 'gate':
+                    sub_state = self._apply_gate(sub_state, op[1], op[2])
+                elif kind == 'kraus':
+                    sub_state = self._apply_kraus(sub_state, op[1], op[2])
+                elif kind == 'measure':
+                    sub_state, outcomes = self._measure(sub_state, op[1])
+                    if op[2] is not None:
+                        memory[op[2][0]][trials, op[2][1]] = outcomes
+                elif op[1] is None:
+                    sub_state = self._init_state(num_qubits, sub_state.shape[0])
+                else:
+                    sub_state, outcomes = self._measure(sub_state, op[1])
+                    flipped = outcomes == 1
+                    if flipped.any():
+                        x = QUANTUM_GATES['X'].astype(np.complex128)
+                        sub_state[flipped] = self._apply_gate(sub_state[flipped], x, (op[1],))
+
+                if full:
+                    state = sub_state
+                else:
+                    state[trials] = sub_state
+            elif kind in ('jump-when', 'jump-unless'):
+                register, offset = op[2]
+                bits = memory[register][trials, offset] != 0
+                if kind == 'jump-unless': bits = ~bits
+                next_pc[bits] = op[1]
+            elif kind == 'jump':
+                next_pc[:] = op[1]
+            elif kind == 'halt':
+                continue
+            elif kind == 'not':
+                register, offset = op[1]
+                memory[register][trials, offset] = 1 - memory[register][trials, offset]
+            else:
+                register, offset = op[1]
+                left = memory[register][trials, offset]
+                right = memory[op[2][0]][trials, op[2][1]] if isinstance(op[2], tuple) else op[2]
+                if kind == 'xor': left = left ^ right
+                elif kind == 'ior': left = left | right
+                elif kind == 'and': left = left & right
+                else: left = np.broadcast_to(right, left.shape)
+                memory[register][trials, offset] = left
+
+            # Regroup trials by their next instruction
+            for target in np.unique(next_pc):
+                moving = trials[next_pc == target]
+                if target in groups:
+                    moving = np.sort(np.concatenate([groups[target], moving]))
+                groups[int(target)] = moving
+
+        return memory
+
+    @abc.abstractmethod
+    def _state_size(self, num_qubits):
+        '''
+        :param Int num_qubits: number of qubits
+        :return: bytes needed to store the state of a single trial
+        '''
+
+    @abc.abstractmethod
+    def _init_state(self, num_qubits, batch):
+        '''
+        :param Int num_qubits: number of qubits
+        :param Int batch: number of trials
+        :return: batch of states with all qubits in the zero state
+        '''
+
+    @abc.abstractmethod
+    def _apply_gate(self, state, matrix, axes):
+        pass
+
+    @abc.abstractmethod
+    def _apply_kraus(self, state, kraus_ops, axes):
+        pass
+
+    @abc.abstractmethod
+    def _measure(self, state, axis):
+        pass
+
+def apply_matrix(tensor, matrix, axes):
+    '''
+    Contract a matrix acting on ``len(axes)`` qubits into the given axes of a tensor
+
+    :param ndarray tensor: tensor with one axis of size two for each qubit
+    :param ndarray matrix: square matrix
+    :param Tuple<int> axes: axes of tensor the matrix acts on
+    :return: contracted tensor
+    '''
+    k = len(axes)
+    matrix = matrix.reshape((2,) * 2 * k)
+    result = np.tensordot(matrix, tensor, axes=(list(range(k, 2 * k)), list(axes)))
+    return np.moveaxis(result, list(range(k)), list(axes))
+
+class DensityMatrixSimulator(BatchExecutor):
+    '''
+    Native NumPy density matrix simulator that runs netQuil programs without a QVM. Supports
+    standard gates, DEFGATE, noisy gates defined with ``define_noisy_gate``, MEASURE, classical
+    control flow (e.g. ``if_then``) and classical logic (e.g. XOR). Density matrices hold 4^n
+    amplitudes, so the simulator is best suited to programs with a handful of qubits.
+
+    The state of a batch is stored as a tensor with one batch axis, followed by one row axis
+    and one column axis for each qubit.
+    '''
+    def _state_size(self, num_qubits):
+        return 16 * 4 ** num_qubits
+
+    def _init_state(self, num_qubits, batch):
+        state = np.zeros((batch, 2 ** num_qubits, 2 ** num_qubits), dtype=np.complex128)
+        state[:, 0, 0] = 1
+        return state.reshape((batch,) + (2,) * 2 * num_qubits)
+
+    def _apply_gate(self, state, matrix, axes):
+        n = (state.ndim - 1) // 2
+        rows = tuple(1 + a for a in axes)
+        cols = tuple(1 + n + a for a in axes)
+        state = apply_matrix(state, matrix, rows)
+        return apply_matrix(state, matrix.conj(), cols)
+
+    def _apply_kraus(self, state, kraus_ops, axes):
+        '''
+        Apply the channel rho -> sum_k K_k rho K_k^dagger with a single einsum over all Kraus operators
+        '''
+        n = (state.ndim - 1) // 2
+        k = len(axes)
+        letters = [chr(ord('a') + i) for i in range(26)] + [chr(ord('A') + i) for i in range(26)]
+        state_idx = letters[:state.ndim]
+        rows_out = letters[state.ndim:state.ndim + k]
+        cols_out = letters[state.ndim + k:state.ndim + 2 * k]
+        kraus_idx = letters[state.ndim + 2 * k]
+
+        out_idx = list(state_idx)
+        for i, a in enumerate(axes):
+            out_idx[1 + a] = rows_out[i]
+            out_idx[1 + n + a] = cols_out[i]
+        kraus_rows = [kraus_idx] + rows_out + [state_idx[1 + a] for a in axes]
+        kraus_cols = [kraus_idx] + cols_out + [state_idx[1 + n + a] for a in axes]
+
+        shape = (len(kraus_ops),) + (2,) * 2 * k
+        ops = kraus_ops.reshape(shape)
+        subscripts = '{},{},{}->{}'.format(''.join(kraus_rows), ''.join(state_idx),
+                                           ''.join(kraus_cols), ''.join(out_idx))
+        return np.einsum(subscripts, ops, state, ops.conj(), optimize=True)
+
+    def _measure(self, state, axis):
+        batch = state.shape[0]
+        n = (state.ndim - 1) // 2
+        diagonal = np.einsum('bii->bi', state.reshape(batch, 2 ** n, 2 ** n)).real
+        diagonal = diagonal.reshape((batch,) + (2,) * n)
+        p1 = np.take(diagonal, 1, axis=1 + axis).reshape(batch, -1).sum(axis=1)
+        outcomes = (self.rng.random(batch) < p1).astype(np.int64)
+
+        # Project each trial onto its outcome and renormalize
+        probs = np.where(outcomes == 1, p1, 1 - p1)
+        keep = (np.arange(2)[None, :] == outcomes[:, None]).astype(state.dtype)
+        row_shape = [batch] + [1] * (2 * n)
+        row_shape[1 + axis] = 2
+        col_shape = [batch] + [1] * (2 * n)
+        col_shape[1 + n + axis] = 2
+        state = state * keep.reshape(row_shape) * keep.reshape(col_shape)
+        state /= np.maximum(probs, 1e-300).reshape([batch] + [1] * (2 * n))
+        return state, outcomes
+
+class TrajectorySimulator(BatchExecutor):
+    '''
+    Native NumPy state vector simulator running noisy programs as Monte-Carlo quantum trajectories.
+    Every trial holds a state vector of 2^n amplitudes, rather than a density matrix of 4^n, and at
+    each noisy gate one of its Kraus operators is applied to each trial, with the probability it
+    has of occurring given the trial's state. Trials are exact samples of the program, like those
+    of the DensityMatrixSimulator, and run as a batch of state vectors.
+
+    The state of a batch is stored as a tensor with one batch axis, followed by one axis for each qubit.
+    '''
+    samples_kraus = True
+
+    def _state_size(self, num_qubits):
+        return 16 * 2 ** num_qubits
+
+    def _init_state(self, num_qubits, batch):
+        state = np.zeros((batch, 2 ** num_qubits), dtype=np.complex128)
+        state[:, 0] = 1
+        return state.reshape((batch,) + (2,) * num_qubits)
+
+    def _apply_gate(self, state, matrix, axes):
+        return apply_matrix(state, matrix, tuple(1 + a for a in axes))
+
+    def _apply_kraus(self, state, kraus_ops, axes):
+        '''
+        Sample a Kraus operator for each trial from the reduced density matrix of the gate's qubits,
+        apply it to the trial and renormalize
+        '''
+        batch, k = state.shape[0], len(axes)
+        local = list(range(1, 1 + k))
+        amplitudes = np.moveaxis(state, [1 + a for a in axes], local)
+        shape = amplitudes.shape
+        amplitudes = amplitudes.reshape(batch, 2 ** k, -1)
+
+        rho = amplitudes @ amplitudes.conj().transpose(0, 2, 1)
+        probs = np.einsum('kij,bjl,kil->bk', kraus_ops, rho, kraus_ops.conj()).real
+        cumulative = np.cumsum(probs, axis=1)
+        draws = self.rng.random(batch) * cumulative[:, -1]
+        choices = np.minimum((cumulative <= draws[:, None]).sum(axis=1), len(kraus_ops) - 1)
+
+        amplitudes = kraus_ops[choices] @ amplitudes
+        amplitudes /= np.sqrt(np.maximum(probs[np.arange(batch), choices], 1e-300))[:, None, None]
+        return np.moveaxis(amplitudes.reshape(shape), local, [1 + a for a in axes])
+
+    def _measure(self, state, axis):
+        batch = state.shape[0]
+        one = [slice(None)] * state.ndim
+        one[1 + axis] = 1
+        amplitudes = state[tuple(one)]
+        p1 = (amplitudes.real ** 2 + amplitudes.imag ** 2).reshape(batch, -1).sum(axis=1)
+        outcomes = (self.rng.random(batch) < p1).astype(np.int64)
+
+        # Project each trial onto its outcome, in place, and renormalize
+        discarded = [slice(None)] * state.ndim
+        for outcome in (0, 1):
+            discarded[0], discarded[1 + axis] = outcomes == outcome, 1 - outcome
+            state[tuple(discarded)] = 0
+        probs = np.where(outcomes == 1, p1, 1 - p1)
+        state /= np.sqrt(np.maximum(probs, 1e-300)).reshape([batch] + [1] * (state.ndim - 1))
+        return state, outcomes
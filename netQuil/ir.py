@@ -0,0 +1,313 @@
+import array
+import itertools
+import numpy as np
+
+from pyquil.quilatom import MemoryReference, Qubit, format_parameter
+from pyquil.quilbase import Declare, Gate, Measurement
+
+__all__ = ["InstructionBuffer"]
+
+# Opcodes of the instructions recorded by an InstructionBuffer
+GATE, MEASURE, INSTRUCTION, READOUT = 0, 1, 2, 3
+
+def _memory_regions(program):
+    '''
+    Returns an index of the memory regions declared by a program, mapping the name of each 
+    region to the position of its DECLARE instruction. The index is kept on the program and 
+    only scans the instructions added since it was last used. It is rebuilt if instructions 
+    it has scanned were inserted, removed or moved since (see _index_is_current).
+
+    :param Program program: program declaring memory regions
+    '''
+    instructions = program._instructions
+    index = getattr(program, '_memory_index', None)
+    if index is None or not _index_is_current(index, instructions):
+        index = [0, {}, None]
+        program._memory_index = index
+
+    scanned, regions, _ = index
+    for position in range(scanned, len(instructions)):
+        if isinstance(instructions[position], Declare):
+            regions[instructions[position].name] = position
+    index[0] = len(instructions)
+    index[2] = instructions[-1] if len(instructions) else None
+    return regions
+
+def _same_instruction(a, b):
+    '''
+    :return: True if a is b, or both declare the same region (declarations are replaced when extended, see noise.readout_slot)
+    '''
+    return a is b or (isinstance(a, Declare) and isinstance(b, Declare) and a.name == b.name)
+
+def _index_is_current(index, instructions):
+    '''
+    :param List index: number of instructions scanned, regions and last instruction scanned (see _memory_regions)
+    :param List instructions: instructions of the program
+    :return: True if the scanned instructions are still in place: the last one scanned and every declaration indexed
+    '''
+    scanned, regions, last = index
+    if scanned > len(instructions) or (scanned and not _same_instruction(instructions[scanned - 1], last)):
+        return False
+    for name, position in regions.items():
+        if position >= len(instructions):
+            return False
+        instruction = instructions[position]
+        if not isinstance(instruction, Declare) or instruction.name != name:
+            return False
+    return True
+
+class InstructionBuffer:
+    def __init__(self):
+        '''
+        Compact record of the instructions added to a program, stored as typed columns rather
+        than as pyquil objects: the opcode, logical time, name and argument of each instruction,
+        and the number of its qubits and parameters, which are stored in flat arrays. Gates and
+        measurements added by netQuil's devices and noise (see noise.measure) are recorded without
+        building any pyquil objects. Any other instruction (e.g. a gate added by an agent's run
+        method) is recorded as the instruction itself. Pyquil instructions are only built when
+        the buffer is materialized (see InstructionBuffer.instructions), and the buffer can be
+        written as Quil without building them (see InstructionBuffer.out).
+
+        For gates, the name is the gate's name and the argument is unused. For measurements, the
+        name is the classical register and the argument is the offset into it (-1 if the qubit is
+        measured without storing the result). For readouts (see InstructionBuffer.readout), the 
+        argument is the bit's index among the buffer's bits of the register. For other instructions, 
+        the argument indexes the instruction in self.objects.
+
+        Declarations, gate definitions and noise pragmas are recorded apart, in self.definitions,
+        as they are hoisted ahead of the other instructions when buffers are merged.
+        '''
+        self.opcodes = array.array('B')
+        self.times = array.array('q')
+        self.names = array.array('l')
+        self.args = array.array('q')
+        self.qubit_counts = array.array('B')
+        self.param_counts = array.array('B')
+        self.qubits = array.array('q')
+        self.params = array.array('d')
+        self.objects = []
+        self.symbols = []
+        self._symbol_ids = {}
+        # Number of bits of each register read out into
+        self.readout_sizes = {}
+        # Tuples of logical time, key and instruction of each definition
+        self.definitions = []
+        self._defined = set()
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def __iter__(self):
+        return iter(self.instructions())
+
+    def _symbol(self, name):
+        '''
+        :param String name: gate or register name
+        :return: index of name in self.symbols
+        '''
+        symbol = self._symbol_ids.get(name)
+        if symbol is None:
+            symbol = self._symbol_ids[name] = len(self.symbols)
+            self.symbols.append(name)
+        return symbol
+
+    def gate(self, name, qubits, params=(), time=0):
+        '''
+        Record a gate without parameters read from classical memory
+
+        :param String name: name of gate, e.g. RX
+        :param List<int> qubits: qubits of gate
+        :param List<float> params: parameters of gate
+        :param Int time: logical time of the agent adding the gate
+        '''
+        self.opcodes.append(GATE)
+        self.times.append(time)
+        self.names.append(self._symbol(name))
+        self.args.append(0)
+        self.qubit_counts.append(len(qubits))
+        self.param_counts.append(len(params))
+        self.qubits.extend(qubits)
+        self.params.extend(params)
+
+    def measure(self, qubit, reference=None, time=0):
+        '''
+        Record a measurement
+
+        :param Int qubit: qubit measured
+        :param MemoryReference reference: bit the result is stored in, or None
+        :param Int time: logical time of the agent adding the measurement
+        '''
+        self.opcodes.append(MEASURE)
+        self.times.append(time)
+        if reference is None:
+            self.names.append(0)
+            self.args.append(-1)
+        else:
+            self.names.append(self._symbol(reference.name))
+            self.args.append(reference.offset)
+        self.qubit_counts.append(1)
+        self.param_counts.append(0)
+        self.qubits.append(qubit)
+
+    def readout(self, qubit, name, time=0):
+        '''
+        Record a measurement into the next bit of a register (e.g. of a lost qubit into its 
+        device's register). Bits are numbered from 0 in each buffer, and only given their offsets 
+        into the register when buffers are merged (see InstructionBuffer.merge).
+
+        :param Int qubit: qubit measured
+        :param String name: name of register
+        :param Int time: logical time of the agent adding the measurement
+        '''
+        slot = self.readout_sizes.get(name, 0)
+        self.readout_sizes[name] = slot + 1
+        self.opcodes.append(READOUT)
+        self.times.append(time)
+        self.names.append(self._symbol(name))
+        self.args.append(slot)
+        self.qubit_counts.append(1)
+        self.param_counts.append(0)
+        self.qubits.append(qubit)
+
+    def define(self, instructions, time=0, key=None):
+        '''
+        Record declarations, gate definitions or pragmas
+
+        :param List instructions: instructions
+        :param Int time: logical time of the agent adding the instructions
+        :param Hashable key: what the instructions define (e.g. a noisy gate's Kraus operators on a 
+            qubit). Instructions with a key already recorded are skipped, here and when merging buffers
+        '''
+        if key is not None:
+            if key in self._defined:
+                return
+            self._defined.add(key)
+        self.definitions.extend((time, key, instruction) for instruction in instructions)
+
+    def is_defined(self, key):
+        '''
+        :param Hashable key: key of definition (see InstructionBuffer.define)
+        :return: True if the buffer records a definition of key
+        '''
+        return key in self._defined
+
+    def append(self, instruction, time=0):
+        '''
+        Record a pyquil instruction
+
+        :param AbstractInstruction instruction: instruction
+        :param Int time: logical time of the agent adding the instruction
+        '''
+        self.opcodes.append(INSTRUCTION)
+        self.times.append(time)
+        self.names.append(0)
+        self.args.append(len(self.objects))
+        self.qubit_counts.append(0)
+        self.param_counts.append(0)
+        self.objects.append(instruction)
+
+    def _rows(self):
+        '''
+        :return: iterator of opcode, name, argument, qubits and parameters of each instruction
+        '''
+        qubits, params = self.qubits.tolist(), self.params.tolist()
+        qubit_ends = itertools.accumulate(self.qubit_counts)
+        param_ends = itertools.accumulate(self.param_counts)
+        qubit_start = param_start = 0
+        for opcode, name, arg, qubit_end, param_end in zip(self.opcodes, self.names, self.args, qubit_ends, param_ends):
+            yield opcode, name, arg, qubits[qubit_start:qubit_end], params[param_start:param_end]
+            qubit_start, param_start = qubit_end, param_end
+
+    def instructions(self, readout_offsets=None):
+        '''
+        Materialize the buffer as pyquil instructions, without its definitions. Instructions are 
+        treated as immutable (see Program.copy), so qubits and gates without parameters are built once and shared.
+
+        :param Dict readout_offsets: offset of the buffer's first bit of each register read out into, 0 by default
+        :return: list of instructions, in the order they were recorded
+        '''
+        symbols, objects = self.symbols, self.objects
+        readout_offsets = readout_offsets or {}
+        qubit_cache, gate_cache = {}, {}
+        instructions = []
+        for opcode, name, arg, qubits, params in self._rows():
+            if opcode == INSTRUCTION:
+                instructions.append(objects[arg])
+                continue
+            for q in qubits:
+                if q not in qubit_cache:
+                    qubit_cache[q] = Qubit(q)
+            if opcode == MEASURE:
+                reference = MemoryReference(symbols[name], arg) if arg >= 0 else None
+                instructions.append(Measurement(qubit_cache[qubits[0]], reference))
+            elif opcode == READOUT:
+                reference = MemoryReference(symbols[name], readout_offsets.get(symbols[name], 0) + arg)
+                instructions.append(Measurement(qubit_cache[qubits[0]], reference))
+            elif params:
+                instructions.append(Gate(symbols[name], params, [qubit_cache[q] for q in qubits]))
+            else:
+                key = (name, tuple(qubits))
+                if key not in gate_cache:
+                    gate_cache[key] = Gate(symbols[name], (), [qubit_cache[q] for q in qubits])
+                instructions.append(gate_cache[key])
+        return instructions
+
+    def out(self):
+        '''
+        Write the buffer as Quil, without materializing it. Definitions are written first, and
+        readouts into the buffer's own bits (see InstructionBuffer.readout).
+
+        :return: string of Quil instructions, one per line
+        '''
+        symbols, objects = self.symbols, self.objects
+        lines = [instruction.out() for _, _, instruction in self.definitions]
+        for opcode, name, arg, qubits, params in self._rows():
+            if opcode == GATE:
+                header = symbols[name]
+                if params:
+                    header += '(' + ', '.join(format_parameter(p) for p in params) + ')'
+                lines.append(' '.join([header] + [str(q) for q in qubits]))
+            elif opcode in (MEASURE, READOUT):
+                lines.append('MEASURE {}'.format(qubits[0]) + (' {}[{}]'.format(symbols[name], arg) if arg >= 0 else ''))
+            else:
+                lines.append(objects[arg].out())
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    @staticmethod
+    def merge(buffers, readout_offsets=None):
+        '''
+        Materialize many buffers in order of logical time. Instructions with the same logical
+        time are ordered by the order of buffers, and then by the order they were recorded.
+
+        :param List<InstructionBuffer> buffers: buffers to merge
+        :param List<Dict> readout_offsets: offsets of each buffer's bits (see InstructionBuffer.instructions)
+        :return: list of pyquil instructions
+        '''
+        readout_offsets = readout_offsets or [None] * len(buffers)
+        pairs = [(buffer, offsets) for buffer, offsets in zip(buffers, readout_offsets) if len(buffer)]
+        if not pairs:
+            return []
+        instructions = list(itertools.chain.from_iterable(buffer.instructions(offsets) for buffer, offsets in pairs))
+        times = np.concatenate([np.frombuffer(buffer.times, dtype=np.int64) for buffer, _ in pairs])
+        return [instructions[i] for i in np.argsort(times, kind='stable')]
+
+    @staticmethod
+    def merge_definitions(buffers, defined=()):
+        '''
+        Merge the definitions of many buffers in order of logical time, as InstructionBuffer.merge.
+        A key defined by several buffers keeps the definition of the buffer reaching it first.
+
+        :param List<InstructionBuffer> buffers: buffers to merge
+        :param Set defined: keys already defined, whose definitions are skipped
+        :return: list of pyquil instructions
+        '''
+        definitions = sorted(((time, b, i, key, instruction) for b, buffer in enumerate(buffers) 
+                              for i, (time, key, instruction) in enumerate(buffer.definitions)), key=lambda d: d[:3])
+        owners = {}
+        instructions = []
+        for _, b, _, key, instruction in definitions:
+            if key is not None:
+                if key in defined or owners.setdefault(key, b) != b:
+                    continue
+            instructions.append(instruction)
+        return instructions
@@ -1,44 +1,229 @@
+import functools
 import numpy as np
-import uuid
 
+from pyquil import Program
 from pyquil.gates import *
-from pyquil.quil import DefGate
+from pyquil.quil import DefGate, Pragma
+from pyquil.quilbase import Declare
 from pyquil.noise import pauli_kraus_map
+from pyquil.quilatom import MemoryReference, format_parameter
+from .agents import _current_agent, add_gate, add_measurement, agent_buffer, program_lock
+from .ir import _memory_regions
 
-__all__ = ["bit_flip", "phase_flip", "depolarizing_noise", "measure","normal_unitary_rotation"]
+__all__ = ["bit_flip", "phase_flip", "depolarizing_noise", "measure", "measure_batch", "readout_slot", "normal_unitary_rotation", "generator", "NoiseModel", "kraus_set"]
 
-ro = None
+# Set by Simulation.run_batched to a TrialSampler drawing outcomes for a batch of trials at once
+sampler = None
+
+def generator(owner=None):
+    '''
+    Random number generator drawing outcomes for a device or agent. Simulations give every agent and
+    device its own numpy.random.Generator for each trial (see Simulation.run), so outcomes do not depend
+    on how agents are scheduled. Defaults to the generator of the agent currently running, and to 
+    NumPy's global random state outside of agents or for devices without a generator.
+
+    :param Agent|Device owner: agent or device drawing outcomes
+    :returns: numpy.random.Generator, or the numpy.random module
+    '''
+    if owner is None:
+        owner = _current_agent.get()
+    rng = getattr(owner, 'rng', None)
+    return rng if rng is not None else np.random
+
+def sample(kind, qubit, draw):
+    '''
+    Draw a random outcome affecting the structure of the program (e.g. photon loss). In a 
+    batched simulation the outcome is drawn for every trial of the batch at once.
+
+    :param String kind: kind of outcome (e.g. "loss")
+    :param Integer|Tuple qubit: qubit the outcome applies to, or tuple of qubits whose outcomes are drawn together
+    :param Function draw: draws an array of outcomes given the number of trials, with one row per trial
+    :returns: outcome of the current trial
+    '''
+    if sampler is not None:
+        return sampler.sample(kind, qubit, draw)
+    return draw(1)[0]
+
+def tally(kind, qubit, draw):
+    '''
+    Draw random outcomes that are only recorded in device statistics (e.g. photon counts)
+    and do not affect the program. 
+
+    :param String kind: kind of outcome (e.g. "photons")
+    :param Integer|Tuple qubit: qubit the outcome applies to, or tuple of qubits whose outcomes are drawn together
+    :param Function draw: draws an array of outcomes given the number of trials, with one row per trial
+    :returns: array of outcomes, one for each trial not yet tallied
+    '''
+    if sampler is not None:
+        return sampler.tally(kind, qubit, draw)
+    return draw(1)
+
+# Pauli matrices shared by the Kraus operators of every channel
+_I = np.eye(2, dtype=np.complex128)
+_X = np.asarray([[0, 1], [1, 0]], dtype=np.complex128)
+_Y = np.asarray([[0, -1.0j], [1.0j, 0]], dtype=np.complex128)
+_Z = np.asarray([[1, 0], [0, -1]], dtype=np.complex128)
 
 def kraus_op_bit_flip(prob: float):
-    noisy_I = np.sqrt(1-prob) * np.asarray([[1, 0], [0, 1]])
-    noisy_X = np.sqrt(prob) * np.asarray([[0, 1], [1, 0]])
-    return [noisy_I, noisy_X]
+    return [np.sqrt(1-prob) * _I, np.sqrt(prob) * _X]
 
 
 def kraus_op_phase_flip(prob: float):
-    noisy_I = np.sqrt(1-prob) * np.asarray([[1, 0], [0, 1]])
-    noisy_Z = np.sqrt(prob) * np.asarray([[1, 0], [0, -1]])
-    return [noisy_I, noisy_Z]
+    return [np.sqrt(1-prob) * _I, np.sqrt(prob) * _Z]
 
 
 def kraus_op_depolarizing_channel(prob: float):
-    noisy_I = np.sqrt(1-prob) * np.asarray([[1, 0], [0, 1]])
-    noisy_X = np.sqrt(prob/3) * np.asarray([[0, 1], [1, 0]])
-    noisy_Z = np.sqrt(prob/3) * np.asarray([[1, 0], [0, -1]])
-    noisy_Y = np.sqrt(prob/3) * np.asarray([[0, 0-1.0j], [0+1.0j, 0]])
-    return [noisy_I, noisy_X, noisy_Y, noisy_Z]
+    return [np.sqrt(1-prob) * _I, np.sqrt(prob/3) * _X, np.sqrt(prob/3) * _Y, np.sqrt(prob/3) * _Z]
+
+# Channels NoiseModels are composed of, with the prefix of their gate names and their Kraus operators
+CHANNELS = {
+    'bit_flip': ("flipNOISE", kraus_op_bit_flip),
+    'phase_flip': ("phaseNOISE", kraus_op_phase_flip),
+    'depolarizing': ("dpNOISE", kraus_op_depolarizing_channel),
+}
 
-def random_unitary(n):
-    # draw complex matrix from Ginibre ensemble
-    z = np.random.randn(n, n) + 1j * np.random.randn(n, n)
-    # QR decompose this complex matrix
-    q, r = np.linalg.qr(z)
-    # make this decomposition unique
-    d = np.diagonal(r)
-    l = np.diag(d) / np.abs(d)
-    return np.matmul(q, l)
+# Number of Kraus sets and channel definitions kept by the caches before the least recently used is evicted.
+# Read once, when the caches are created at import
+_KRAUS_CACHE_SIZE = 256
 
+@functools.lru_cache(maxsize=_KRAUS_CACHE_SIZE)
+def kraus_set(channels):
+    '''
+    Kraus operators of a sequence of channels applied one after the other, composed into a single
+    set. A composed set is reduced to at most four operators (the eigenvectors of its Choi matrix),
+    so composing channels never grows the set. Sets are computed once and cached, and are read-only.
 
+    :param Tuple channels: pairs of channel name (see CHANNELS) and probability
+    :returns: tuple of 2x2 NumPy arrays
+    '''
+    kraus_ops = [_I]
+    for channel, prob in channels:
+        kraus_ops = [k @ op for k in CHANNELS[channel][1](prob) for op in kraus_ops]
+
+    if len(channels) > 1:
+        vectors = np.asarray([k.ravel() for k in kraus_ops])
+        eigenvalues, eigenvectors = np.linalg.eigh(vectors.T @ vectors.conj())
+        kraus_ops = [np.sqrt(value) * eigenvectors[:, i].reshape(2, 2)
+                     for i, value in reversed(list(enumerate(eigenvalues))) if value > 1e-12]
+
+    for k in kraus_ops:
+        k.setflags(write=False)
+    return tuple(kraus_ops)
+
+@functools.lru_cache(maxsize=_KRAUS_CACHE_SIZE)
+def _definition(channels):
+    '''
+    Returns the definition of a sequence of channels, computing and caching it on first use. Each 
+    sequence is defined by a single identity DefGate whose name only depends on the channels and 
+    probabilities, overloaded by their composed Kraus operators.
+
+    :param Tuple channels: pairs of channel name (see CHANNELS) and probability
+    :returns: name of gate, its DefGate and the Kraus operators formatted for PRAGMA ADD-KRAUS
+    '''
+    name = '_'.join(CHANNELS[channel][0] + '_' + repr(prob).replace('.', '_') for channel, prob in channels)
+    kraus_strings = ["({})".format(" ".join(map(format_parameter, k.ravel()))) for k in kraus_set(channels)]
+    return name, DefGate(name, np.eye(2)), kraus_strings
+
+def _noisy_qubits(program):
+    '''
+    Returns the set of (gate name, qubit) pairs a program defines Kraus operators for. 
+    The set is built from the program's pragmas on first use and kept on the program.
+
+    :param Program program: program noise is applied to
+    '''
+    noisy_qubits = getattr(program, '_noisy_qubits', None)
+    if noisy_qubits is None:
+        noisy_qubits = set()
+        for inst in program.instructions:
+            if isinstance(inst, Pragma) and inst.command == 'ADD-KRAUS':
+                noisy_qubits.add((inst.args[0],) + tuple(getattr(q, 'index', q) for q in inst.args[1:]))
+        program._noisy_qubits = noisy_qubits
+    return noisy_qubits
+
+def _apply_channel(program, qubit, channels):
+    '''
+    Apply a sequence of noise channels as a single noisy gate, adding its DefGate and Kraus 
+    operators to the program only the first time it is applied to the program and qubit, respectively.
+    While agents' instructions are buffered, they are recorded as definitions of the agent's buffer.
+
+    :param Program program: program to apply noise to
+    :param Integer qubit: qubit to apply noise to 
+    :param Tuple channels: pairs of channel name (see CHANNELS) and probability
+    '''
+    name, definition, kraus_strings = _definition(channels)
+    buffered = agent_buffer(program, [qubit])
+    if buffered is not None:
+        # Definitions are recorded once per agent, and once per program when buffers are merged (see InstructionBuffer.define)
+        buffer, time = buffered
+        if not buffer.is_defined(name) and all(gate.name != name for gate in program.defined_gates):
+            buffer.define([definition], time, key=name)
+        if not buffer.is_defined((name, qubit)) and (name, qubit) not in _noisy_qubits(program):
+            buffer.define([Pragma('ADD-KRAUS', (name, qubit), kraus_string) for kraus_string in kraus_strings], time, key=(name, qubit))
+        buffer.gate(name, [qubit], (), time)
+        return
+
+    with program_lock(program):
+        if all(gate.name != name for gate in program.defined_gates):
+            program += definition
+
+        noisy_qubits = _noisy_qubits(program)
+        if (name, qubit) not in noisy_qubits:
+            noisy_qubits.add((name, qubit))
+            for kraus_string in kraus_strings:
+                program += Pragma('ADD-KRAUS', (name, qubit), kraus_string)
+    add_gate(program, name, [qubit])
+
+class NoiseModel:
+    def __init__(self, *channels):
+        '''
+        Single-qubit noise made of channels applied one after the other, e.g. 
+        NoiseModel(('bit_flip', 0.01), ('depolarizing', 0.02)). The channels are composed ahead of
+        time into one Kraus set (see kraus_set), so the model is applied to a qubit as a single noisy 
+        gate rather than one gate per channel. Noise models can be attached to devices, which apply 
+        them to every qubit passing through them (see Device.noise_model).
+
+        :param Tuple channels: pairs of channel name (bit_flip, phase_flip or depolarizing) and probability
+        '''
+        for channel, prob in channels:
+            if channel not in CHANNELS:
+                raise Exception('Noise channel must be one of {}'.format(sorted(CHANNELS)))
+            if not 0 <= prob <= 1:
+                raise Exception('Probability of noise channel must be between 0 and 1')
+        self.channels = tuple((channel, float(prob)) for channel, prob in channels)
+
+    def __repr__(self):
+        return 'NoiseModel{}'.format(self.channels)
+
+    def __eq__(self, other):
+        return isinstance(other, NoiseModel) and self.channels == other.channels
+
+    def __hash__(self):
+        return hash(self.channels)
+
+    def compose(self, *models):
+        '''
+        :param NoiseModel models: models applied after this one
+        :returns: NoiseModel applying this model and then each of models
+        '''
+        return NoiseModel(*(self.channels + sum((model.channels for model in models), ())))
+
+    def kraus_ops(self):
+        '''
+        :returns: tuple of the model's composed Kraus operators
+        '''
+        return kraus_set(self.channels)
+
+    def apply(self, program, qubits):
+        '''
+        Apply the model to each qubit
+
+        :param Program program: program to apply noise to
+        :param List<int> qubits: qubits to apply noise to
+        '''
+        if not self.channels:
+            return
+        for qubit in qubits:
+            _apply_channel(program, qubit, self.channels)
 
 def bit_flip(program, qubit, prob: float):
     '''
@@ -48,13 +233,7 @@ def bit_flip(program, qubit, prob: float):
     :param Integer qubit: qubit to apply noise to 
     :param Float prob: probability of apply noise 
     '''
-    unique_id = uuid.uuid1().int
-
-    flip_noisy_I_definition = DefGate("flipNOISE" + str(unique_id), random_unitary(2))
-    program += flip_noisy_I_definition
-    
-    program.define_noisy_gate("flipNOISE" + str(unique_id), [qubit], kraus_op_bit_flip(prob))
-    program += ("flipNOISE" + str(unique_id), qubit)
+    _apply_channel(program, qubit, (('bit_flip', float(prob)),))
 
 def phase_flip(program, qubit, prob: float):
     '''
@@ -64,14 +243,7 @@ def phase_flip(program, qubit, prob: float):
     :param Integer qubit: qubit to apply noise to 
     :param Float prob: probability of apply noise 
     '''
-
-    unique_id = uuid.uuid1().int
-
-    phase_noisy_I_definition = DefGate("phaseNOISE" + str(unique_id), random_unitary(2))
-    program += phase_noisy_I_definition
-    
-    program.define_noisy_gate("phaseNOISE" + str(unique_id), [qubit], kraus_op_phase_flip(prob))
-    program += ("phaseNOISE" + str(unique_id), qubit)
+    _apply_channel(program, qubit, (('phase_flip', float(prob)),))
 
 def depolarizing_noise(program, qubit, prob: float):
     '''
@@ -81,47 +253,89 @@ def depolarizing_noise(program, qubit, prob: float):
     :param Integer qubit: qubit to apply noise to 
     :param Float prob: probability of apply noise 
     '''
-    unique_id = uuid.uuid1().int
+    _apply_channel(program, qubit, (('depolarizing', float(prob)),))
 
-    dp_noisy_I_definition = DefGate("dpNOISE" + str(unique_id), random_unitary(2))
-    program += dp_noisy_I_definition
-    
-    program.define_noisy_gate("dpNOISE" + str(unique_id), [qubit], kraus_op_depolarizing_channel(prob))
-    program += ("dpNOISE" + str(unique_id), qubit)
+def readout_slot(program, name):
+    '''
+    Allocate the next bit of a device's classical register, declaring the register on first
+    use and extending its declaration by one bit afterwards, so every measurement recorded by 
+    a device has its own bit. Bits are allocated under the program's lock, as agents receiving
+    qubits allocate them concurrently (see agents.program_lock).
+
+    :param Program program: program to allocate bit in
+    :param String name: name of quil classical register (e.g. name of device)
+    :returns: MemoryReference to allocated bit
+    '''
+    with program_lock(program):
+        regions = _memory_regions(program)
+        if name not in regions:
+            # Declared on the program itself, even while agents' declarations are buffered
+            Program.inst(program, Declare(name, 'BIT', 1))
+            return MemoryReference(name, 0)
+
+        position = regions[name]
+        declaration = program._instructions[position]
+        slot = declaration.memory_size
+        program._instructions[position] = Declare(name, declaration.memory_type, slot + 1)
+        program._synthesized_instructions = None
+    return MemoryReference(name, slot)
+
+def _readout(program, qubit, name):
+    '''
+    Measure a qubit into its own bit of a register. While agents' instructions are buffered, bits
+    are numbered by each agent and given their offsets when buffers are merged (see 
+    InstructionBuffer.readout), so bits do not depend on how agents are scheduled.
+
+    :param Program program: program to measure qubit in
+    :param Integer qubit: qubit to measure
+    :param String name: name of quil classical register
+    '''
+    buffered = agent_buffer(program, [qubit])
+    if buffered is None:
+        add_measurement(program, qubit, readout_slot(program, name))
+        return
+    buffer, time = buffered
+    buffer.readout(qubit, name, time)
 
-def measure(program, qubit, prob: float, name):
+def measure(program, qubit, prob: float, name, rng=None):
     '''
     Measure the qubit with probability
 
     :param Program program: program to apply noise to
     :param Integer qubit: qubit to apply noise to 
     :param Float prob: probability of apply noise 
-    :param String name: name of quil classical register to measure to.
+    :param String name: name of quil classical register to measure to. Each measured qubit is given its own bit (see readout_slot)
+    :param numpy.random.Generator rng: random number generator, defaults to the current agent's (see generator)
     :returns: None if qubit is not measured and qubit if qubit is measured
     '''
-    if np.random.rand()> prob:
-        global ro
-
-        devices_ro_exists = False
-        ro_exists = False
-        for inst in program.instructions: 
-            try: 
-                if inst.name == name:
-                    devices_ro_exists = True
-                elif inst.name == "ro":
-                    ro_exists = True
-            except: pass
-
-        if not ro_exists:
-            ro = program.declare("ro", 'BIT', 1)
-        elif ro_exists and not devices_ro_exists:
-            ro = program.declare(name, 'BIT', 1)
-
-        program += MEASURE(qubit, ro)
+    rng = rng if rng is not None else generator()
+    if sample("loss", qubit, lambda trials: rng.random(trials) > prob):
+        _readout(program, qubit, name)
         return qubit
     return None
 
-def normal_unitary_rotation(program, qubit, prob:float, variance):
+def measure_batch(program, qubits, prob: float, name, rng=None):
+    '''
+    Measure each qubit with probability, drawing the outcomes of all qubits in a single call
+
+    :param Program program: program to apply noise to
+    :param List<int> qubits: qubits to apply noise to 
+    :param Float prob: probability of apply noise 
+    :param String name: name of quil classical register to measure to. Each measured qubit is given its own bit (see readout_slot)
+    :param numpy.random.Generator rng: random number generator, defaults to the current agent's (see generator)
+    :returns: boolean NumPy array, True for each qubit measured
+    '''
+    if not len(qubits):
+        return np.zeros(0, dtype=bool)
+
+    rng = rng if rng is not None else generator()
+    measured = np.asarray(sample("loss", tuple(qubits), lambda trials: rng.random((trials, len(qubits))) > prob))
+    for qubit, lost in zip(qubits, measured):
+        if lost:
+            _readout(program, qubit, name)
+    return measured
+
+def normal_unitary_rotation(program, qubit, prob:float, variance, rng=None):
     '''
     Apply X and Z rotation with probability
 
@@ -129,9 +343,11 @@ def normal_unitary_rotation(program, qubit, prob:float, variance):
     :param Integer qubit: qubit to apply noise to 
     :param Float prob: probability of apply noise 
     :param Float variance: variance of rotation angle
+    :param numpy.random.Generator rng: random number generator, defaults to the current agent's (see generator)
     '''
-    if np.random.rand() > prob:
-        x_angle, z_angle = np.random.normal(0, variance, 2)
-        program += RX(x_angle, qubit)
-        program += RZ(z_angle, qubit)
+    rng = rng if rng is not None else generator()
+    if sample("rotation", qubit, lambda trials: rng.random(trials) > prob):
+        x_angle, z_angle = sample("angles", qubit, lambda trials: rng.normal(0, variance, (trials, 2)))
+        add_gate(program, 'RX', [qubit], [x_angle])
+        add_gate(program, 'RZ', [qubit], [z_angle])
     
\ No newline at end of file
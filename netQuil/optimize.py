@@ -0,0 +1,122 @@
+import numpy as np
+
+from pyquil.gates import RY, RZ
+from pyquil.quilbase import (Gate, Measurement, Pragma, ResetQubit, Jump, JumpWhen, JumpUnless,
+                             JumpTarget, Halt, Wait, Reset)
+from .executor import gate_matrix, parse_kraus_pragma, _index
+
+__all__ = ["fuse_gates"]
+
+# Pragmas that declare noise rather than delimit blocks of instructions
+NOISE_PRAGMAS = ('ADD-KRAUS', 'READOUT-POVM')
+
+def fuse_gates(program, atol=1e-9):
+    '''
+    Optimization pass fusing runs of single-qubit gates on the same qubit (e.g. the RX and RZ
+    rotations devices add at every hop) into at most three rotations, RZ RY RZ, and dropping runs
+    that amount to the identity (up to global phase). A run is only replaced if it becomes shorter.
+
+    Gates overloaded by noise (PRAGMA ADD-KRAUS, e.g. noise.bit_flip and NoiseModel) are never fused
+    and end the runs of their qubits, as do multi-qubit gates, measurements and resets. Gates with
+    parameters read from classical memory are not fused. Control flow and pragmas other than noise
+    pragmas end the runs of every qubit. Runs pass over instructions on other qubits, so the fused
+    gates are placed where the run ends.
+
+    :param Program program: program to optimize, e.g. a program returned by Simulation.run
+    :param Float atol: tolerance under which matrices are considered equal
+    :returns: new program with the same definitions and fused instructions
+    '''
+    defined_gates = {definition.name: np.asarray(definition.matrix, dtype=np.complex128)
+                     for definition in program.defined_gates if not definition.parameters}
+    noisy_gates = {(name, qubits) for name, qubits, _ in
+                   (parse_kraus_pragma(inst) for inst in program.instructions
+                    if isinstance(inst, Pragma) and inst.command == 'ADD-KRAUS')}
+
+    optimized = program.copy_everything_except_instructions()
+    runs = {}
+
+    def flush(qubit):
+        gates, matrix = runs.pop(qubit)
+        optimized.inst(_fused(gates, matrix, qubit, atol))
+
+    for inst in program.instructions:
+        if isinstance(inst, Gate):
+            qubits = tuple(_index(q) for q in inst.qubits)
+            matrix = None
+            if len(qubits) == 1 and (inst.name, qubits) not in noisy_gates:
+                try:
+                    matrix = gate_matrix(inst, defined_gates)
+                except Exception:
+                    matrix = None
+            if matrix is not None and matrix.shape == (2, 2):
+                gates, run = runs.get(qubits[0], ([], np.eye(2, dtype=np.complex128)))
+                runs[qubits[0]] = (gates + [(inst, matrix)], matrix @ run)
+                continue
+            for q in qubits:
+                if q in runs: flush(q)
+        elif isinstance(inst, (Measurement, ResetQubit)):
+            if _index(inst.qubit) in runs: flush(_index(inst.qubit))
+        elif isinstance(inst, (Jump, JumpWhen, JumpUnless, JumpTarget, Halt, Wait, Reset)) or \
+                (isinstance(inst, Pragma) and inst.command not in NOISE_PRAGMAS):
+            for q in list(runs): flush(q)
+        optimized.inst(inst)
+
+    for q in list(runs): flush(q)
+    return optimized
+
+def _fused(gates, matrix, qubit, atol):
+    '''
+    :param List gates: run of single-qubit gates, as tuples of gate and matrix
+    :param Array matrix: product of the gates' matrices
+    :param Int qubit: qubit of the run
+    :param Float atol: tolerance under which matrices are considered equal
+    :returns: shortest list of gates equal to the run up to global phase
+    '''
+    identity = np.eye(2, dtype=np.complex128)
+    gates = [gate for gate, unitary in gates if not _equal_up_to_phase(unitary, identity, atol)]
+    rotations = [gate(angle, qubit) for gate, angle in zip((RZ, RY, RZ), zyz_angles(matrix))
+                 if abs(angle) > atol]
+    if len(rotations) >= len(gates):
+        return gates
+
+    # Guard against decompositions that lose precision
+    fused = np.eye(2, dtype=np.complex128)
+    for gate in rotations:
+        fused = gate_matrix(gate, {}) @ fused
+    if not _equal_up_to_phase(fused, matrix, atol):
+        return gates
+    return rotations
+
+def zyz_angles(matrix):
+    '''
+    Euler angles of a single-qubit unitary, U = e^{i phase} RZ(alpha) RY(beta) RZ(gamma)
+
+    :param Array matrix: 2x2 unitary
+    :returns: angles gamma, beta and alpha, in the order their rotations are applied
+    '''
+    special = matrix / np.sqrt(np.linalg.det(matrix))
+    beta = 2 * np.arctan2(abs(special[1, 0]), abs(special[0, 0]))
+    total = 2 * np.angle(special[1, 1]) if abs(special[1, 1]) > 1e-12 else 0.0
+    difference = 2 * np.angle(special[1, 0]) if abs(special[1, 0]) > 1e-12 else 0.0
+    if abs(special[1, 1]) <= 1e-12:
+        total = difference
+    elif abs(special[1, 0]) <= 1e-12:
+        difference = total
+    alpha, gamma = (total + difference) / 2, (total - difference) / 2
+    return [_wrap(gamma), _wrap(beta), _wrap(alpha)]
+
+def _wrap(angle):
+    '''
+    :param Float angle: angle in radians
+    :returns: equivalent angle in [-pi, pi)
+    '''
+    return float((angle + np.pi) % (2 * np.pi) - np.pi)
+
+def _equal_up_to_phase(a, b, atol):
+    '''
+    :returns: True if matrices a and b are equal up to a global phase
+    '''
+    overlap = np.vdot(a, b)
+    if abs(overlap) <= atol:
+        return False
+    return np.allclose(a * (overlap / abs(overlap)), b, atol=max(atol, 1e-7))
@@ -0,0 +1,139 @@
+import threading
+
+__all__ = ["Profiler"]
+
+# Set by a Simulation created with profile=True while it runs and resets trials
+profiler = None
+
+class Profiler:
+    def __init__(self):
+        '''
+        Records where a simulation spends its time: the wall time of each agent's run, the time
+        agents are blocked receiving from quantum and classical connections, the number of calls,
+        qubits and cumulative latency of each device (consecutive devices fused by a Pipeline are
+        recorded together), and the time taken by each trial and by resetting agents and devices
+        between trials. Every method may be called from any agent's thread.
+
+        AsyncAgents do not block while receiving: their wall time spans from when they start to when 
+        they finish, and their receiving time is the time spent waiting for messages, while other agents run.
+        '''
+        self.lock = threading.Lock()
+        self.agents = {}
+        self.devices = {}
+        self.trials = []
+        self.instructions = []
+        self.resets = []
+
+    def __getstate__(self):
+        '''
+        Profilers are pickled without their lock
+        '''
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _agent(self, name):
+        return self.agents.setdefault(name, {'runs': 0, 'wall_time': 0.0, 'quantum_wait': 0.0, 'classical_wait': 0.0})
+
+    def record_agent(self, name, seconds):
+        '''
+        :param String name: name of agent
+        :param Float seconds: wall time of one run of the agent
+        '''
+        with self.lock:
+            agent = self._agent(name)
+            agent['runs'] += 1
+            agent['wall_time'] += seconds
+
+    def record_wait(self, name, kind, seconds):
+        '''
+        :param String name: name of agent receiving
+        :param String kind: quantum or classical
+        :param Float seconds: time agent was blocked receiving
+        '''
+        with self.lock:
+            self._agent(name)[kind + '_wait'] += seconds
+
+    def record_device(self, name, qubits, seconds):
+        '''
+        :param String name: name of device, or names of fused devices joined by +
+        :param Int qubits: number of qubits passing through device
+        :param Float seconds: time taken to apply device
+        '''
+        with self.lock:
+            device = self.devices.setdefault(name, {'calls': 0, 'qubits': 0, 'time': 0.0})
+            device['calls'] += 1
+            device['qubits'] += qubits
+            device['time'] += seconds
+
+    def record_trial(self, seconds, instructions):
+        '''
+        :param Float seconds: wall time of trial
+        :param Int instructions: number of instructions of the trial's program
+        '''
+        with self.lock:
+            self.trials.append(seconds)
+            self.instructions.append(instructions)
+
+    def record_reset(self, seconds):
+        '''
+        :param Float seconds: time taken to reset agents and devices after a trial
+        '''
+        with self.lock:
+            self.resets.append(seconds)
+
+    def merge(self, other):
+        '''
+        Add the records of another profiler (e.g. of a worker process) to this one
+
+        :param Profiler other: profiler to merge
+        '''
+        with self.lock:
+            for name, agent in other.agents.items():
+                totals = self._agent(name)
+                for key, value in agent.items():
+                    totals[key] += value
+            for name, device in other.devices.items():
+                totals = self.devices.setdefault(name, {'calls': 0, 'qubits': 0, 'time': 0.0})
+                for key, value in device.items():
+                    totals[key] += value
+            self.trials += other.trials
+            self.instructions += other.instructions
+            self.resets += other.resets
+
+    def report(self):
+        '''
+        :return: dictionary of trials, resets, agents and devices. Agents are keyed on name and
+            include their busy time, i.e. wall time not spent receiving
+        '''
+        with self.lock:
+            agents = {name: dict(agent, busy_time=agent['wall_time'] - agent['quantum_wait'] - agent['classical_wait'])
+                      for name, agent in self.agents.items()}
+            return {
+                'trials': {'count': len(self.trials), 'total_time': sum(self.trials),
+                           'mean_time': sum(self.trials) / len(self.trials) if self.trials else 0.0,
+                           'mean_instructions': sum(self.instructions) / len(self.instructions) if self.instructions else 0.0},
+                'resets': {'count': len(self.resets), 'total_time': sum(self.resets),
+                           'mean_time': sum(self.resets) / len(self.resets) if self.resets else 0.0},
+                'agents': agents,
+                'devices': {name: dict(device) for name, device in self.devices.items()},
+            }
+
+    def display(self):
+        '''
+        Prints the report
+        '''
+        report = self.report()
+        trials, resets = report['trials'], report['resets']
+        print('{} trials in {:.6f}s ({:.6f}s per trial, {:.1f} instructions per program)'.format(
+            trials['count'], trials['total_time'], trials['mean_time'], trials['mean_instructions']))
+        print('{} resets in {:.6f}s ({:.6f}s per reset)'.format(resets['count'], resets['total_time'], resets['mean_time']))
+        for name, agent in sorted(report['agents'].items()):
+            print('Agent {}: {:.6f}s wall, {:.6f}s busy, {:.6f}s receiving qubits, {:.6f}s receiving cbits'.format(
+                name, agent['wall_time'], agent['busy_time'], agent['quantum_wait'], agent['classical_wait']))
+        for name, device in sorted(report['devices'].items()):
+            print('Device {}: {} calls, {} qubits, {:.6f}s'.format(name, device['calls'], device['qubits'], device['time']))
@@ -0,0 +1,106 @@
+__all__ = ["QubitRegister"]
+
+class QubitRegister:
+    def __init__(self, qubits=()):
+        '''
+        Ordered set of the qubits owned by an agent. Membership, adding and removing qubits take
+        constant time, and qubits keep the order in which they were added, so the register can be
+        iterated, unpacked and indexed like the list of qubits given to the agent. Qubits lost in
+        transmission are removed from the register and recorded as lost (see QubitRegister.lost).
+
+        :param List<int> qubits: qubits owned by agent
+        '''
+        self._qubits = dict.fromkeys(qubits)
+        self._order = None
+        self._lost = {}
+
+    def __contains__(self, qubit):
+        return qubit in self._qubits
+
+    def __iter__(self):
+        '''
+        Iterates over the qubits at the time iteration starts, so agents may send qubits
+        while iterating over their register
+        '''
+        return iter(self._ordered())
+
+    def __len__(self):
+        return len(self._qubits)
+
+    def __getitem__(self, index):
+        '''
+        Qubits are indexed in the order they were added. The order is cached until the register changes.
+        '''
+        return self._ordered()[index]
+
+    def _ordered(self):
+        '''
+        :return: list of qubits in order, cached until the register changes
+        '''
+        if self._order is None:
+            self._order = list(self._qubits)
+        return self._order
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self._qubits))
+
+    def __copy__(self):
+        register = QubitRegister(self._qubits)
+        register._lost = self._lost.copy()
+        return register
+
+    @property
+    def lost(self):
+        '''
+        :return: list of qubits lost while being sent to the agent, in the order they were lost
+        '''
+        return list(self._lost)
+
+    def add(self, qubit):
+        '''
+        :param Int qubit: qubit to add
+        '''
+        self._qubits[qubit] = None
+        self._order = None
+
+    def update(self, qubits):
+        '''
+        Add many qubits at once (e.g. qubits received from another agent)
+
+        :param List<int> qubits: qubits to add
+        '''
+        self._qubits.update(dict.fromkeys(qubits))
+        self._order = None
+
+    def issuperset(self, qubits):
+        '''
+        :param List<int> qubits: qubits to look for
+        :return: True if every qubit is in the register
+        '''
+        return all(q in self._qubits for q in qubits)
+
+    def difference_update(self, qubits):
+        '''
+        Remove many qubits at once (e.g. qubits sent to another agent). Qubits not in the
+        register are ignored.
+
+        :param List<int> qubits: qubits to remove
+        '''
+        for q in qubits:
+            self._qubits.pop(q, None)
+        self._order = None
+
+    def lose(self, qubits):
+        '''
+        Remove qubits lost during transmission and record them as lost
+
+        :param List<int> qubits: qubits lost
+        '''
+        self.difference_update(qubits)
+        self._lost.update(dict.fromkeys(qubits))
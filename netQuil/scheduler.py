@@ -0,0 +1,206 @@
+import collections
+import heapq
+import itertools
+import time
+
+from .agents import _current_agent
+from .asynchronous import AsyncSimulation
+from .clock import MasterClock
+from .connections import QConnect, signal_speed
+from netQuil import profiling
+
+__all__ = ["EventScheduler", "EventSimulation"]
+
+class _Receive:
+    def __init__(self, mailbox):
+        '''
+        Awaitable request, yielded to the scheduler, to receive the next message of a mailbox
+
+        :param _Mailbox mailbox: mailbox to receive from
+        '''
+        self.mailbox = mailbox
+
+    def __await__(self):
+        item = yield self
+        return item
+
+class _Mailbox:
+    def __init__(self, scheduler, connection):
+        '''
+        Queue of an agent on a connection, whose messages are delivered by the scheduler
+        at their arrival time. Replaces the connection's queue during an EventSimulation.
+
+        :param EventScheduler scheduler: scheduler delivering messages
+        :param QConnect|CConnect connection: connection owning the mailbox
+        '''
+        self.scheduler = scheduler
+        self.connection = connection
+        self.items = collections.deque()
+        self.waiter = None
+
+    def put_nowait(self, item):
+        self.scheduler.schedule(self.scheduler.arrival_time(self.connection, item),
+                                self.scheduler._deliver, self, item)
+
+    def get(self):
+        return _Receive(self)
+
+class EventScheduler:
+    def __init__(self, master_clock=None):
+        '''
+        Discrete-event scheduler running AsyncAgents in simulated time. Events are kept in a
+        priority queue keyed on simulated time, with ties broken by the order in which they were
+        scheduled, so agents run deterministically and idle periods are skipped. Messages
+        are delivered to their target's mailbox at their arrival time, and an agent waiting on
+        a mailbox resumes when its next message is delivered. The scheduler owns the master clock,
+        which it advances to the time of each event.
+
+        :param MasterClock master_clock: master clock advanced by the scheduler
+        '''
+        self.master_clock = master_clock if master_clock is not None else MasterClock()
+        self.events = []
+        self.counter = itertools.count()
+        self.now = 0.0
+        self.current = None
+        self.coroutines = {}
+        self.waiting = set()
+        # Wall clock time of each agent's first step, when profiling
+        self.started = {}
+
+    def schedule(self, time, action, *args):
+        '''
+        Schedule an action at a simulated time
+
+        :param Float time: simulated time of the event
+        :param Function action: function called when the event is processed
+        '''
+        heapq.heappush(self.events, (time, next(self.counter), action, args))
+
+    def arrival_time(self, connection, item):
+        '''
+        Simulated time a message placed on a connection's queue reaches the target. Qubits
+        arrive once they have left the source's devices and taken the delay of the transit and 
+        target devices they are certain to pass through (see Pipeline.delay). The delay of 
+        devices reached depending on which qubits are lost is only drawn when the qubits are 
+        received. Cbits arrive once they have traveled the length of the classical connection.
+
+        :param QConnect|CConnect connection: connection carrying the message
+        :param Tuple item: message placed on the queue by the connection
+        :return: arrival time
+        '''
+        if isinstance(connection, QConnect):
+            traveling_qubits, lost_qubits, pipeline, source_delay, source_time, _ = item
+            # Pipelines are not applied to messages whose qubits were all lost by source devices (see QConnect._receive)
+            delay = pipeline.delay if traveling_qubits else pipeline.default_delay
+            return max(self.now, source_time + source_delay + delay*(len(traveling_qubits) + len(lost_qubits)))
+        cbits, source_delay, _ = item
+        sender_time = self.current.time if self.current is not None else self.now
+        travel_delay = connection.length/signal_speed*len(cbits)
+        # Senders are delayed by the source delay of each cbit (see Agent.csend)
+        return max(self.now, sender_time + source_delay*len(cbits) + travel_delay)
+
+    def spawn(self, agent):
+        '''
+        Schedule an AsyncAgent to start running at its local time
+
+        :param AsyncAgent agent: agent to run
+        '''
+        self.coroutines[agent] = agent.run()
+        self.schedule(agent.time, self._step, agent, None)
+
+    def run(self):
+        '''
+        Process events in order of simulated time until no events are left
+        '''
+        while self.events:
+            time, _, action, args = heapq.heappop(self.events)
+            self.now = max(self.now, time)
+            self.master_clock.time = max(self.master_clock.time, self.now)
+            action(*args)
+
+        if self.waiting:
+            names = sorted(agent.name for agent in self.waiting)
+            raise Exception('Agents {} are waiting for messages that were never sent'.format(names))
+
+    def _deliver(self, mailbox, item):
+        '''
+        Deliver a message to a mailbox, resuming the agent waiting on it
+        '''
+        if mailbox.waiter is None:
+            mailbox.items.append(item)
+        else:
+            agent = mailbox.waiter
+            mailbox.waiter = None
+            self.waiting.discard(agent)
+            self._step(agent, item)
+
+    def _step(self, agent, value):
+        '''
+        Resume an agent until it waits on an empty mailbox or finishes
+
+        :param AsyncAgent agent: agent to resume
+        :param value: message to resume the agent with
+        '''
+        coroutine = self.coroutines[agent]
+        self.current = agent
+        token = _current_agent.set(agent)
+        profiler = profiling.profiler
+        if profiler is not None and agent not in self.started:
+            self.started[agent] = time.perf_counter()
+        try:
+            while True:
+                request = coroutine.send(value)
+                if not isinstance(request, _Receive):
+                    raise Exception('Agents run by an EventScheduler may only await netQuil communication')
+                mailbox = request.mailbox
+                if mailbox.items:
+                    value = mailbox.items.popleft()
+                    continue
+                mailbox.waiter = agent
+                self.waiting.add(agent)
+                break
+        except StopIteration:
+            del self.coroutines[agent]
+            # Like AsyncAgents on an event loop, the wall time of an agent spans from its first step to its last
+            if profiler is not None:
+                profiler.record_agent(agent.name, time.perf_counter() - self.started.pop(agent))
+        finally:
+            _current_agent.reset(token)
+            self.current = None
+
+class EventSimulation(AsyncSimulation):
+    def __init__(self, *args, check_ownership=True, profile=False, buffer_instructions=True):
+        '''
+        Simulation of AsyncAgents driven by an EventScheduler in simulated time, rather than
+        by the interleaving of threads or tasks. Each trial is deterministic given the state of
+        the random number generator. EventSimulation supports the same methods and arguments as 
+        Simulation (e.g. run and run_batched).
+        '''
+        AsyncSimulation.__init__(self, *args, check_ownership=check_ownership, profile=profile, buffer_instructions=buffer_instructions)
+        self.scheduler = None
+
+    def _run_trial(self, network_monitor=False):
+        '''
+        Run every agent once on a new scheduler
+
+        :param Boolean network_monitor: outputs each network transaction and device information
+        :return: program generated by the trial
+        '''
+        master_clock = self._start_trial()
+        self.scheduler = EventScheduler(master_clock)
+        for connection in self._connections():
+            connection.queues = {name: _Mailbox(self.scheduler, connection) for name in connection.queues}
+        for agent in self.agents:
+            self.scheduler.spawn(agent)
+
+        try:
+            self.scheduler.run()
+        finally:
+            self.scheduler = None
+
+        if network_monitor:
+            for agent in self.agents:
+                agent._get_device_results()
+            master_clock.display_transactions()
+
+        return self.agents[0].program
@@ -1,70 +1,138 @@
-import inspect
+import collections
+import itertools
+import multiprocessing
+import pickle
+import time
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from .clock import *
+from .agents import instruction_hook
+from .batch import TrialSampler, group_programs
+from netQuil import noise, profiling
+from .profiling import Profiler
+from .template import ProgramTemplate
 
 from pyquil import Program
 
-__all__ = ["Simulation"]
+__all__ = ["Simulation", "TrialResult"]
+
+# Simulation unpickled by each worker process of a parallel run
+_worker_simulation = None
 
-# Attributes to keep on newly instantiated agent when resetting agents
-THREADING_ATTRS = ['_started', '_stderr', '_tstate_lock', '_initialized', '_indent', '_is_stopped', '_target']
+class TrialResult:
+    def __init__(self, trial, program, master_clock, device_stats, lost_qubits):
+        '''
+        Program and metadata generated by a single trial of a simulation
+
+        :param Int trial: index of trial
+        :param PyQuil<Program> program: program generated by trial
+        :param MasterClock master_clock: master clock of trial, holding its transactions (see MasterClock.to_array)
+        :param List<Dict> device_stats: statistics of each device (see Device.get_stats), in the order devices are attached to agents and connections
+        :param List<int> lost_qubits: qubits lost during transmission
+        '''
+        self.trial = trial
+        self.program = program
+        self.master_clock = master_clock
+        self.device_stats = device_stats
+        self.lost_qubits = lost_qubits
+
+    @property
+    def transactions(self):
+        '''
+        :return: list of transactions recorded by the master clock, formatted as strings
+        '''
+        return self.master_clock.transactions
 
 class Simulation:
-    def __init__(self, *args):
+    def __init__(self, *args, check_ownership=True, profile=False, buffer_instructions=True):
         '''
         Initialize the simulation
+
+        :param Boolean check_ownership: check that agents only add instructions for qubits they own. 
+            Turn off to remove the cost of checking (e.g. for large sweeps of a tested network)
+        :param Boolean profile: record where each run spends its time in self.profiler (see Profiler)
+        :param Boolean buffer_instructions: agents add instructions to their own buffers, which are merged
+            into the program in causal order at the end of each trial, so programs do not depend on how 
+            agents are scheduled. Turn off to add instructions to the program as agents run
         '''
         self.agents = list(args)
+        self.check_ownership = check_ownership
+        self.buffer_instructions = buffer_instructions
+        self.profile = profile
+        self.profiler = None
         self.pbars = {}
+        self.pool = None
+        self.pool_size = 0
 
     def _create_agent_copies(self):
         '''
-        Creates a dictionary of attributes for each agent. Stores list of dictionaries on self.agent_copies.
+        Snapshots the state of each agent and stores the list of snapshots on self.agent_copies.
         Used to reset agents to their original state before each trial. Execute this function once at beginning of run
         if client requests multiple trials
         '''
-        self.agent_copies = []
-        program = self.agents[0].program.copy()
+        self.agent_copies = [agent.snapshot() for agent in self.agents]
+        self.program_template = ProgramTemplate(self.agents[0].program)
+
+    def _reset_agents(self):
+        '''
+        Restores every agent in place from the snapshots taken by _create_agent_copies, 
+        and gives agents a new program sharing the instructions of the original program (see ProgramTemplate)
+        '''
+        program_copy = self.program_template.program()
+        for agent, copy in zip(self.agents, self.agent_copies): 
+            agent.restore(copy)
+            agent.program = program_copy
+
+    def _get_pool(self):
+        '''
+        Returns the pool of workers running agents, creating it on first use. The pool is reused
+        across trials and has one worker for each agent, since agents block on each other.
+        '''
+        if self.pool is None or self.pool_size < len(self.agents):
+            self.close()
+            self.pool = ThreadPoolExecutor(max_workers=len(self.agents))
+            self.pool_size = len(self.agents)
+        return self.pool
+
+    def close(self):
+        '''
+        Shut down the simulation's pool of workers
+        '''
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def _connections(self):
+        '''
+        :return: list of every quantum and classical connection between agents
+        '''
+        connections = {}
+        for agent in self.agents:
+            for connection in list(agent.qconnections.values()) + list(agent.cconnections.values()):
+                connections[id(connection)] = connection
+        return list(connections.values())
+
+    def _devices(self):
+        '''
+        :return: list of every source, transit and target device, without duplicates
+        '''
+        devices = {}
         for agent in self.agents:
-            # Get attributes
-            attributes = inspect.getmembers(agent, lambda a:not(inspect.isroutine(a)))
-            # Remove private funcs and pythonic attrs 
-            attrs_tuples = [a for a in attributes if not(a[0].startswith('__') and a[0].endswith('__'))]
-            attrs_dict = dict(attrs_tuples)
-            attrs_clean = {k: v for k, v in attrs_dict.items() if k not in THREADING_ATTRS}
-            attrs_clean["program"] = program
-            self.agent_copies.append(attrs_clean)
-
-    def _reset_agents(self, agent_classes):
-        '''
-        Creates exact duplicate of original agent given the class constructor and 
-        a dictionary of agent attributes from _create_agent_copies
-
-        :param List<Agent> agent_classes: list of agent classes 
-        '''
-        program_copy = None
-        for indx, copy in enumerate(self.agent_copies): 
-            # Create copy of agent
-            new_agent = agent_classes[indx]()
-            for k in copy:
-                try: 
-                    setattr(new_agent, k, copy[k])
-                    if k == 'program' and program_copy == None:
-                        program_copy = copy[k].copy()
-                    if k == 'program': 
-                        setattr(new_agent, k, program_copy)
-                except: 
-                    pass
-            self.agents[indx] = new_agent
+            for device in agent.source_devices + agent.target_devices:
+                devices[id(device)] = device
+        for connection in self._connections():
+            for transit_devices in getattr(connection, 'transit_devices', {}).values():
+                for device in transit_devices:
+                    devices[id(device)] = device
+        return list(devices.values())
 
     def _reset_devices(self):
         '''
-        Reset source devices for each agent after each trial. 
+        Reset every device after each trial. 
         '''
-        for agent in self.agents: 
-            for connection in agent.qconnections.values():
-                connection.agents = {a.name: a for a in self.agents}
-            for device in agent.source_devices:
-                device.reset()
+        for device in self._devices(): 
+            device.reset()
 
     def _add_program(self):
         '''
@@ -80,50 +148,291 @@ class Simulation:
             if agent.program == None: 
                 agent.program = p
 
-    def run(self, trials=1, agent_classes=[], network_monitor=False):
+    def run(self, trials=1, agent_classes=[], network_monitor=False, workers=None, seed=None):
         '''
         Run the simulation
 
         :param Int trials: number of times to simulate program
-        :param List<Agent> agent_classes: list of agent classes
+        :param List<Agent> agent_classes: list of agent classes (no longer required, agents are restored in place)
         :param Boolean network_monitor: outputs each network transaction and device information
+        :param Int workers: number of worker processes to shard trials across. Defaults to running trials in this process
+        :param Int seed: seed of the random number generators. Each trial is seeded independently from seed, 
+            and every agent and device is given its own generator (see _seed_trial), so programs do not depend 
+            on the number of workers or on how agents are scheduled. Defaults to a seed drawn from NumPy's 
+            global random state
         :return: returns list of programs. One for each trial
         '''
+        return [result.program for result in self.iter_run(trials, network_monitor, workers, seed)]
+
+    def iter_run(self, trials=1, network_monitor=False, workers=None, seed=None, max_pending=None):
+        '''
+        Run the simulation, yielding the program and metadata of each trial as soon as it completes. 
+        Only the current trial is held in memory, so trials can be analyzed while the simulation runs.
+
+        :param Int trials: number of times to simulate program
+        :param Boolean network_monitor: outputs each network transaction and device information
+        :param Int workers: number of worker processes to shard trials across. Defaults to running trials in this process
+        :param Int seed: seed of the random number generator (see run)
+        :param Int max_pending: maximum number of shards of trials worker processes may run ahead of the 
+            consumer. Defaults to twice the number of workers
+        :return: generator of TrialResults, in trial order
+        '''
         # If program is not set, add default
         self._add_program()
+        self.profiler = Profiler() if self.profile else None
+
+        if workers is not None and workers > 1:
+            yield from self._iter_parallel(trials, workers, network_monitor, seed, max_pending)
+            return
         
-        programs = []
         running_trials = trials > 1 
+        entropy = _entropy(seed)
 
         # If trials is greater than 1, create copies of each agent
         if running_trials: self._create_agent_copies()
 
-        for _ in range(trials): 
+        for trial in range(trials): 
+            self._seed_trial(entropy, trial)
 
-            # Start master clock and network monitor
-            master_clock = MasterClock()
-            for agent in self.agents:
-                agent.master_clock = master_clock
+            # Record program generated from trial
+            program = self._execute_trial(network_monitor)
+            result = self._trial_result(trial, program)
+
+            # Reset agents if multiple trials
+            if running_trials:
+                self._profiled_reset()
+
+            yield result
+
+    def _trial_result(self, trial, program):
+        '''
+        Collect the metadata of the trial that just completed
+
+        :param Int trial: index of trial
+        :param PyQuil<Program> program: program generated by trial
+        :return: TrialResult
+        '''
+        device_stats = [dict(device.get_stats(), name=getattr(device, 'name', type(device).__name__)) for device in self._devices()]
+        lost_qubits = [q for connection in self._connections() for q in getattr(connection, 'lost_qubits', [])]
+        return TrialResult(trial, program, self.agents[0].master_clock, device_stats, lost_qubits)
+
+    def _iter_parallel(self, trials, workers, network_monitor=False, seed=None, max_pending=None):
+        '''
+        Shard trials across a pool of worker processes. Each worker unpickles its own copy of the
+        simulation, so agents, devices and module globals (e.g. noise.sampler) are isolated between workers. 
+        Shards are yielded in order as they complete, and at most max_pending shards are in flight.
+
+        :param Int trials: number of times to simulate program
+        :param Int workers: number of worker processes
+        :param Boolean network_monitor: outputs each network transaction and device information
+        :param Int seed: seed of the random number generator
+        :param Int max_pending: maximum number of shards submitted but not yet consumed
+        :return: generator of TrialResults, in trial order
+        '''
+        entropy = _entropy(seed)
+        max_pending = max_pending if max_pending is not None else 2 * workers
+        self._create_agent_copies()
 
-            # Start agents, tracer, and network monitor
-            for idx, agent in enumerate(self.agents):
-                agent._start_tracer()
-                agent.start()
+        # Several shards per worker balance the load when trials take different amounts of time
+        shard_size = max(1, -(-trials // (4 * workers)))
+        shards = iter([(start, min(start + shard_size, trials), entropy, network_monitor) for start in range(0, trials, shard_size)])
 
-            # Wait for agents to finish 
-            for agent in self.agents: 
-                agent.join()
+        # Prefer fork, which does not require agent classes to be importable by the workers
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, 
+                                 initializer=_init_worker, initargs=(pickle.dumps(self),)) as pool:
+            pending = collections.deque()
+            for shard in itertools.islice(shards, max(1, max_pending)):
+                pending.append(pool.submit(_run_shard, *shard))
+            while pending:
+                results, profiler = pending.popleft().result()
+                for shard in itertools.islice(shards, 1):
+                    pending.append(pool.submit(_run_shard, *shard))
+                if profiler is not None:
+                    self.profiler.merge(profiler)
+                yield from results
 
-            if network_monitor: 
+    def __getstate__(self):
+        '''
+        Simulations are pickled without their pool of workers
+        '''
+        state = self.__dict__.copy()
+        state['pool'] = None
+        state['pool_size'] = 0
+        return state
+
+    def _execute_trial(self, network_monitor=False):
+        '''
+        Run a trial and merge the instructions buffered by agents into its program, recording 
+        its time and the size of its program when profiling
+
+        :param Boolean network_monitor: outputs each network transaction and device information
+        :return: program generated by the trial
+        '''
+        if self.profiler is None:
+            return self._merge_instructions(self._run_trial(network_monitor))
+
+        profiling.profiler = self.profiler
+        try:
+            start = time.perf_counter()
+            program = self._merge_instructions(self._run_trial(network_monitor))
+            self.profiler.record_trial(time.perf_counter() - start, len(program.instructions))
+        finally:
+            profiling.profiler = None
+        return program
+
+    def _merge_instructions(self, program):
+        '''
+        Append the instructions buffered by each agent during a trial to the trial's program, 
+        ordered by the agents' logical times (see Agent.logical_time) and then by the order of agents
+
+        :param PyQuil<Program> program: program generated by the trial
+        :return: program
+        '''
+        instruction_hook(program, self.check_ownership).merge([agent.name for agent in self.agents])
+        return program
+
+    def _profiled_reset(self, devices=True):
+        '''
+        Reset agents, and devices, after a trial, recording the time taken when profiling
+
+        :param Boolean devices: reset devices as well as agents
+        '''
+        start = time.perf_counter()
+        self._reset_agents()
+        if devices: self._reset_devices()
+        if self.profiler is not None:
+            self.profiler.record_reset(time.perf_counter() - start)
+
+    def _seed_trial(self, entropy, trial):
+        '''
+        Give every agent and device its own random number generator for a trial, spawned from the
+        run's seed sequence independently of all other trials, agents and devices. Agents are keyed 
+        on their position in the simulation and devices on their position in _devices. NumPy's global 
+        random state is left to the caller, so agents and devices drawing from it directly are not seeded
+        (except on worker processes, see _run_shard).
+
+        :param Int entropy: entropy of the run's seed sequence
+        :param Int trial: index of trial
+        '''
+        for kind, owners in enumerate((self.agents, self._devices())):
+            for idx, owner in enumerate(owners):
+                owner.rng = np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(trial, kind, idx)))
+
+    def _start_trial(self):
+        '''
+        Start a new master clock shared by all agents, clear the lost qubits and compiled routes of 
+        connections (devices may have changed), turn ownership checks on or off for the agents' program,
+        and start buffering the instructions of each agent
+
+        :return: master clock
+        '''
+        hook = instruction_hook(self.agents[0].program, self.check_ownership)
+        if self.buffer_instructions:
+            hook.start()
+        master_clock = MasterClock()
+        for agent in self.agents:
+            agent.master_clock = master_clock
+        for connection in self._connections():
+            if hasattr(connection, 'lost_qubits'):
+                connection.lost_qubits = []
+                connection.routes = {}
+        return master_clock
+
+    def _run_trial(self, network_monitor=False):
+        '''
+        Run every agent once
+
+        :param Boolean network_monitor: outputs each network transaction and device information
+        :return: program generated by the trial
+        '''
+        master_clock = self._start_trial()
+
+        # Run agents on the pool of workers
+        pool = self._get_pool()
+        futures = [pool.submit(agent._execute) for agent in self.agents]
+
+        # Wait for agents to finish 
+        for future in futures: 
+            future.result()
+
+        if network_monitor: 
+            for agent in self.agents:
                 agent._get_device_results()
-                master_clock.display_transactions()
+            master_clock.display_transactions()
 
-            # Record program generated from trial
-            programs.append(self.agents[0].program)
+        return self.agents[0].program
 
-            # Reset agents if multiple trials
-            if running_trials:
-                self._reset_agents(agent_classes)
-                self._reset_devices()
+    def run_batched(self, trials=1, agent_classes=[], seed=None):
+        '''
+        Run the simulation for many trials while only replaying the agents once for each 
+        structurally distinct trial. Outcomes drawn through the noise module (e.g. Fiber loss and
+        Laser photon counts) are sampled as arrays for all trials at once, and trials sharing 
+        the same outcomes share a single program. Randomness drawn outside of the noise module
+        is shared by every trial of a replay.
+
+        :param Int trials: number of times to simulate program
+        :param List<Agent> agent_classes: list of agent classes (no longer required, agents are restored in place)
+        :param Int seed: seed of the random number generators (see run)
+        :return: list of tuples of program and array of indices of the trials it represents. 
+            Each program can be executed once with as many shots as trials it represents (see run_batches)
+        '''
+        # If program is not set, add default
+        self._add_program()
+        self._seed_trial(_entropy(seed), 0)
+        self._create_agent_copies()
+        self.profiler = Profiler() if self.profile else None
+
+        sampler = TrialSampler(trials)
+        batches = []
+        noise.sampler = sampler
+        try:
+            while sampler.next_replay():
+                program = self._execute_trial()
+                batches.append((program, sampler.trials))
+                self._profiled_reset(devices=False)
+        finally:
+            noise.sampler = None
+
+        return group_programs(batches)
+
+def _entropy(seed):
+    '''
+    :param Int seed: seed of a run, or None to draw one from NumPy's global random state
+    :return: entropy of the run's seed sequence
+    '''
+    if seed is None:
+        seed = np.random.randint(2 ** 32, size=4, dtype=np.uint64).tolist()
+    return np.random.SeedSequence(seed).entropy
+
+def _init_worker(state):
+    '''
+    Unpickle the simulation run by a worker process
+
+    :param Bytes state: pickled simulation
+    '''
+    global _worker_simulation
+    _worker_simulation = pickle.loads(state)
+
+def _run_shard(start, stop, entropy, network_monitor):
+    '''
+    Run trials start to stop on a worker process
 
-        return programs
\ No newline at end of file
+    :param Int start: index of first trial
+    :param Int stop: index after last trial
+    :param Int entropy: entropy of the run's seed sequence
+    :param Boolean network_monitor: outputs each network transaction and device information
+    :return: list of TrialResults, one for each trial, and the shard's Profiler (None unless profiling)
+    '''
+    simulation = _worker_simulation
+    simulation.profiler = Profiler() if simulation.profile else None
+    results = []
+    for trial in range(start, stop):
+        simulation._profiled_reset()
+        simulation._seed_trial(entropy, trial)
+        # Forked workers inherit the same global random state, which is seeded for each trial so agents
+        # and devices drawing from it directly do not make the same draws on every worker
+        np.random.seed(np.random.SeedSequence(entropy, spawn_key=(trial, 2)).generate_state(4))
+        program = simulation._execute_trial(network_monitor)
+        results.append(simulation._trial_result(trial, program))
+    return results, simulation.profiler
@@ -0,0 +1,273 @@
+import functools
+import numpy as np
+
+from .executor import Executor, BatchExecutor, DensityMatrixSimulator, TrajectorySimulator, compile_program, batch_memory_default
+
+__all__ = ["StabilizerSimulator", "NativeSimulator", "is_clifford"]
+
+# Single-qubit Paulis keyed on their x and z bits, as in a stabilizer tableau (Y for x = z = 1)
+_PAULIS = {
+    (0, 0): np.eye(2, dtype=np.complex128),
+    (1, 0): np.array([[0, 1], [1, 0]], dtype=np.complex128),
+    (1, 1): np.array([[0, -1j], [1j, 0]], dtype=np.complex128),
+    (0, 1): np.array([[1, 0], [0, -1]], dtype=np.complex128),
+}
+
+@functools.lru_cache(maxsize=None)
+def _pauli_basis(k):
+    '''
+    Every Pauli on k qubits, indexed by their bits: bit j of the index is the x bit of qubit j,
+    and bit k + j its z bit. Qubit 0 is the most significant, as in gate_matrix.
+
+    :param Int k: number of qubits
+    :return: arrays of x bits and z bits, each of shape (4^k, k), and of Pauli matrices
+    '''
+    indices = np.arange(4 ** k)
+    x = (indices[:, None] >> np.arange(k)) & 1
+    z = (indices[:, None] >> (k + np.arange(k))) & 1
+    matrices = []
+    for xs, zs in zip(x, z):
+        matrix = np.ones((1, 1), dtype=np.complex128)
+        for bits in zip(xs, zs):
+            matrix = np.kron(matrix, _PAULIS[tuple(bits)])
+        matrices.append(matrix)
+    return x.astype(np.uint8), z.astype(np.uint8), np.stack(matrices)
+
+def _pauli_coefficients(matrices, k):
+    '''
+    :param Array matrices: stack of matrices on k qubits
+    :param Int k: number of qubits
+    :return: coefficients of each matrix in the Pauli basis, of shape (len(matrices), 4^k)
+    '''
+    _, _, paulis = _pauli_basis(k)
+    return np.einsum('qij,pji->pq', paulis, matrices) / 2 ** k
+
+def clifford_table(matrix, atol=1e-9):
+    '''
+    Action of a Clifford gate on Paulis, i.e. the Pauli U P U^dagger for every Pauli P on the
+    gate's qubits, which is how a stabilizer tableau is updated by the gate
+
+    :param Array matrix: unitary of gate
+    :param Float atol: tolerance under which coefficients are considered equal
+    :return: arrays of x bits, z bits and sign flips of the image of each Pauli (see _pauli_basis),
+        or None if the gate is not a Clifford gate
+    '''
+    return _clifford_table(matrix.shape[0], matrix.tobytes(), atol)
+
+@functools.lru_cache(maxsize=256)
+def _clifford_table(dim, data, atol):
+    k = dim.bit_length() - 1
+    matrix = np.frombuffer(data, dtype=np.complex128).reshape(dim, dim)
+    x, z, paulis = _pauli_basis(k)
+    coefficients = _pauli_coefficients(matrix @ paulis @ matrix.conj().T, k)
+    images = np.argmax(np.abs(coefficients), axis=1)
+    signs = coefficients[np.arange(len(images)), images]
+    if not np.allclose(np.abs(signs), 1, atol=atol) or not np.allclose(signs.imag, 0, atol=atol):
+        return None
+    return x[images], z[images], (signs.real < 0).astype(np.uint8)
+
+def pauli_channel(kraus_ops, atol=1e-9):
+    '''
+    Probabilities of a Pauli channel, e.g. noise.bit_flip, noise.phase_flip, noise.depolarizing_noise
+    or a NoiseModel composing them, whatever Kraus operators it is given by
+
+    :param Array kraus_ops: stack of Kraus operators
+    :param Float atol: tolerance under which coefficients are considered zero
+    :return: probability of each Pauli (see _pauli_basis), or None if the channel is not a Pauli channel
+    '''
+    return _pauli_channel(kraus_ops.shape, kraus_ops.tobytes(), atol)
+
+@functools.lru_cache(maxsize=256)
+def _pauli_channel(shape, data, atol):
+    k = shape[1].bit_length() - 1
+    coefficients = _pauli_coefficients(np.frombuffer(data, dtype=np.complex128).reshape(shape), k)
+    # Process matrix of the channel in the Pauli basis, diagonal for Pauli channels
+    chi = coefficients.T @ coefficients.conj()
+    probabilities = chi.diagonal().real
+    if not np.allclose(chi - np.diag(probabilities), 0, atol=atol):
+        return None
+    return probabilities / probabilities.sum()
+
+def is_clifford(operations):
+    '''
+    :param List operations: operations from compile_program
+    :return: True if every gate is a Clifford gate and every noisy gate a Pauli channel
+    '''
+    for op in operations:
+        if op[0] == 'gate' and clifford_table(op[1]) is None:
+            return False
+        if op[0] == 'kraus' and pauli_channel(op[1]) is None:
+            return False
+    return True
+
+def _rowsum(h, i, n):
+    '''
+    Multiply tableau rows h by rows i (Aaronson and Gottesman's rowsum)
+
+    :param Array h: rows, each holding n x bits, n z bits and a sign bit
+    :param Array i: rows to multiply by, broadcastable to h
+    :param Int n: number of qubits
+    :return: rows of the products
+    '''
+    x1, z1 = i[..., :n].astype(np.int8), i[..., n:2 * n].astype(np.int8)
+    x2, z2 = h[..., :n].astype(np.int8), h[..., n:2 * n].astype(np.int8)
+    # Exponent of i picked up by each qubit when multiplying the Paulis
+    g = np.where(x1 & z1, z2 - x2, np.where(x1, z2 * (2 * x2 - 1), np.where(z1, x2 * (1 - 2 * z2), 0)))
+    phase = (2 * h[..., 2 * n].astype(np.int64) + 2 * i[..., 2 * n] + g.sum(axis=-1, dtype=np.int64)) % 4
+    rows = np.empty(np.broadcast_shapes(h.shape, i.shape), dtype=np.uint8)
+    rows[..., :2 * n] = h[..., :2 * n] ^ i[..., :2 * n]
+    rows[..., 2 * n] = phase == 2
+    return rows
+
+def _product_sign(rows, n):
+    '''
+    Sign of the product of tableau rows, in order, when the product is Hermitian (e.g. commuting
+    stabilizers). Writing each row as (-1)^r i^(x.z) X^x Z^z, moving every Z^z past the X^x of
+    later rows picks up (-1)^(z.x), so the product is (-1)^(sum of r) i^(sum of x.z) (-1)^(sum over 
+    earlier rows a and later rows b of z_a.x_b) X^X Z^Z, where X and Z are the parities of the bits.
+
+    :param Array rows: batch of rows of shape (batch, rows, 2n + 1). Rows of zeros are the identity
+    :param Int n: number of qubits
+    :return: sign bit of each product
+    '''
+    x, z, r = rows[..., :n], rows[..., n:2 * n], rows[..., 2 * n]
+    # Parity of the z bits of the rows before each row
+    earlier_z = np.bitwise_xor.accumulate(z, axis=1) ^ z
+    x_total, z_total = np.bitwise_xor.reduce(x, axis=1), np.bitwise_xor.reduce(z, axis=1)
+    phase = ((x & z).sum(axis=(1, 2), dtype=np.int64) + 2 * (earlier_z & x).sum(axis=(1, 2), dtype=np.int64)
+             + 2 * r.sum(axis=1, dtype=np.int64) - (x_total & z_total).sum(axis=1, dtype=np.int64)) % 4
+    return (phase == 2).astype(np.int64)
+
+class StabilizerSimulator(BatchExecutor):
+    '''
+    Native stabilizer simulator running programs made of Clifford gates (e.g. H, S, CNOT, CZ and
+    the Paulis, standard or defined with DEFGATE), Pauli noise (e.g. from noise.bit_flip,
+    noise.phase_flip, noise.depolarizing_noise or a NoiseModel), MEASURE and classical control flow,
+    in time and memory polynomial in the number of qubits. Pauli channels are simulated by sampling
+    a Pauli error for each trial. Other gates and channels raise an exception (see NativeSimulator).
+
+    The state of a trial is a stabilizer tableau (Aaronson and Gottesman, 2004) of n destabilizer
+    rows followed by n stabilizer rows, each holding n x bits, n z bits and a sign bit. The state
+    of a batch is stored as a uint8 array of shape (batch, 2n, 2n + 1).
+    '''
+    samples_kraus = True
+
+    def _state_size(self, num_qubits):
+        return 2 * num_qubits * (2 * num_qubits + 1)
+
+    def _init_state(self, num_qubits, batch):
+        n = num_qubits
+        state = np.zeros((batch, 2 * n, 2 * n + 1), dtype=np.uint8)
+        state[:, np.arange(n), np.arange(n)] = 1
+        state[:, n + np.arange(n), n + np.arange(n)] = 1
+        return state
+
+    def _apply_gate(self, state, matrix, axes):
+        table = clifford_table(matrix)
+        if table is None:
+            raise Exception('Gate is not a Clifford gate and cannot be run by a StabilizerSimulator')
+        x_images, z_images, flips = table
+
+        n = (state.shape[2] - 1) // 2
+        axes = list(axes)
+        z_axes = [n + a for a in axes]
+        weights = 1 << np.arange(len(axes))
+        index = (state[:, :, axes] @ weights) + ((state[:, :, z_axes] @ weights) << len(axes))
+        state[:, :, axes] = x_images[index]
+        state[:, :, z_axes] = z_images[index]
+        state[:, :, 2 * n] ^= flips[index]
+        return state
+
+    def _apply_kraus(self, state, kraus_ops, axes):
+        '''
+        Sample a Pauli error for each trial, and flip the sign of the rows it anticommutes with
+        '''
+        probabilities = pauli_channel(kraus_ops)
+        if probabilities is None:
+            raise Exception('Noisy gate is not a Pauli channel and cannot be run by a StabilizerSimulator')
+        x, z, _ = _pauli_basis(len(axes))
+        errors = np.searchsorted(np.cumsum(probabilities), self.rng.random(state.shape[0]), side='right')
+        errors = np.minimum(errors, len(probabilities) - 1)
+
+        n = (state.shape[2] - 1) // 2
+        axes = list(axes)
+        anticommutes = (state[:, :, axes] & z[errors][:, None, :]) ^ (state[:, :, [n + a for a in axes]] & x[errors][:, None, :])
+        state[:, :, 2 * n] ^= anticommutes.sum(axis=2, dtype=np.uint8) & 1
+        return state
+
+    def _measure(self, state, axis):
+        batch = state.shape[0]
+        n = (state.shape[2] - 1) // 2
+        outcomes = np.zeros(batch, dtype=np.int64)
+
+        # Outcomes are random in trials where a stabilizer anticommutes with Z on the qubit
+        random = state[:, n:, axis].any(axis=1)
+
+        trials = np.flatnonzero(random)
+        if len(trials):
+            sub_state = state[trials]
+            rows = np.arange(len(trials))
+            p = n + np.argmax(sub_state[:, n:, axis], axis=1)
+            pivot = sub_state[rows, p]
+
+            # Multiply every other row anticommuting with Z by the pivot
+            update = sub_state[:, :, axis].astype(bool)
+            update[rows, p] = False
+            trial_idx, row_idx = np.nonzero(update)
+            sub_state[trial_idx, row_idx] = _rowsum(sub_state[trial_idx, row_idx], pivot[trial_idx], n)
+
+            outcome = self.rng.integers(0, 2, len(trials))
+            sub_state[rows, p - n] = sub_state[rows, p]
+            sub_state[rows, p] = 0
+            sub_state[rows, p, n + axis] = 1
+            sub_state[rows, p, 2 * n] = outcome
+            state[trials] = sub_state
+            outcomes[trials] = outcome
+
+        # Otherwise the outcome is the sign of the product of the stabilizers paired with the
+        # destabilizers anticommuting with Z on the qubit
+        trials = np.flatnonzero(~random)
+        if len(trials):
+            selected = state[trials, :n, axis]
+            rows = np.flatnonzero(selected.any(axis=0))
+            products = state[trials[:, None], n + rows] * selected[:, rows, None]
+            outcomes[trials] = _product_sign(products, n)
+
+        return state, outcomes
+
+class NativeSimulator(Executor):
+    '''
+    Native executor choosing, for each program, the StabilizerSimulator if every gate of the
+    program is a Clifford gate and every noisy gate a Pauli channel (see is_clifford), the
+    DensityMatrixSimulator for other programs on few qubits, whose trials share a single exact 
+    state until they are measured, and the TrajectorySimulator for programs on more qubits, whose
+    density matrices would not fit in memory. All share the executor's random number generator.
+    '''
+    def __init__(self, seed=None, batch_memory=batch_memory_default, max_density_matrix_qubits=10):
+        '''
+        :param Int seed: seed of the executor's random number generator
+        :param Int batch_memory: maximum bytes of state held in memory at once
+        :param Int max_density_matrix_qubits: largest number of qubits run by the DensityMatrixSimulator
+        '''
+        Executor.__init__(self, seed, batch_memory)
+        self.max_density_matrix_qubits = max_density_matrix_qubits
+        self.stabilizer = StabilizerSimulator(batch_memory=batch_memory)
+        self.density_matrix = DensityMatrixSimulator(batch_memory=batch_memory)
+        self.trajectory = TrajectorySimulator(batch_memory=batch_memory)
+        self.stabilizer.rng = self.density_matrix.rng = self.trajectory.rng = self.rng
+
+    def select(self, operations, num_qubits):
+        '''
+        :param List operations: operations from compile_program
+        :param Int num_qubits: number of qubits of program
+        :return: executor that will run the operations
+        '''
+        if is_clifford(operations):
+            return self.stabilizer
+        if num_qubits <= self.max_density_matrix_qubits:
+            return self.density_matrix
+        return self.trajectory
+
+    def execute(self, program, trials=1):
+        operations, qubits, declarations = compile_program(program)
+        return self.select(operations, len(qubits))._execute_compiled(operations, qubits, declarations, trials)
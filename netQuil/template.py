@@ -0,0 +1,135 @@
+import itertools
+from collections.abc import MutableSequence
+
+from netQuil import noise
+from .ir import _memory_regions
+
+__all__ = ["ProgramTemplate"]
+
+class ProgramTemplate:
+    def __init__(self, program):
+        '''
+        Frozen copy of a program (e.g. the declarations and state preparation shared by every
+        trial of a simulation) from which new programs are made in constant time. The template's
+        instructions are copied once, and each new program only stores the instructions added to
+        it (see ProgramTemplate.program). The memory regions and noisy gates of the template,
+        which noise looks up when devices add instructions, are also indexed once.
+
+        :param PyQuil<Program> program: program to freeze. Later changes to program do not change the template
+        '''
+        self.prefix = tuple(program._instructions)
+        self.header = program.copy_everything_except_instructions()
+        self.header._instructions = _CopyOnWriteInstructions(self.prefix)
+        self.memory_index = list(_memory_regions(self.header).items())
+        self.noisy_qubits = frozenset(noise._noisy_qubits(self.header))
+
+    def program(self):
+        '''
+        :return: new program starting with the template's instructions, sharing them with the
+            template until they are modified
+        '''
+        program = self.header.copy_everything_except_instructions()
+        program._instructions = _CopyOnWriteInstructions(self.prefix)
+        program._memory_index = [len(self.prefix), dict(self.memory_index), self.prefix[-1] if self.prefix else None]
+        program._noisy_qubits = set(self.noisy_qubits)
+        return program
+
+class _CopyOnWriteInstructions(MutableSequence):
+    def __init__(self, prefix, suffix=None, overrides=None):
+        '''
+        List of instructions made of a frozen prefix shared with a ProgramTemplate, and of the
+        instructions appended since. Replacing an instruction of the prefix (e.g. extending a
+        declaration, see noise.readout_slot) is recorded as an override, and inserting or
+        deleting instructions of the prefix copies it.
+
+        :param Tuple prefix: shared instructions
+        :param List suffix: instructions appended after the prefix
+        :param Dict overrides: replaced instructions of the prefix, keyed on position
+        '''
+        self._prefix = prefix
+        self._suffix = suffix if suffix is not None else []
+        self._overrides = overrides if overrides is not None else {}
+
+    def _own(self):
+        '''
+        Copy the prefix, after which the list no longer shares instructions with its template
+        '''
+        self._suffix = list(self)
+        self._prefix = ()
+        self._overrides = {}
+
+    def _position(self, index):
+        '''
+        :param Int index: index, possibly negative
+        :return: non-negative index, raising IndexError if it is out of range
+        '''
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError('list index out of range')
+        return index
+
+    def __len__(self):
+        return len(self._prefix) + len(self._suffix)
+
+    def __iter__(self):
+        if not self._overrides:
+            return itertools.chain(self._prefix, self._suffix)
+        return itertools.chain((self._overrides.get(i, inst) for i, inst in enumerate(self._prefix)), self._suffix)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        index = self._position(index)
+        if index >= len(self._prefix):
+            return self._suffix[index - len(self._prefix)]
+        return self._overrides.get(index, self._prefix[index])
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self._own()
+            self._suffix[index] = value
+            return
+        index = self._position(index)
+        if index >= len(self._prefix):
+            self._suffix[index - len(self._prefix)] = value
+        else:
+            self._overrides[index] = value
+
+    def __delitem__(self, index):
+        if isinstance(index, int) and self._position(index) >= len(self._prefix):
+            del self._suffix[self._position(index) - len(self._prefix)]
+            return
+        self._own()
+        del self._suffix[index]
+
+    def insert(self, index, value):
+        if index >= len(self) or (index >= len(self._prefix) and index >= 0):
+            self._suffix.insert(index - len(self._prefix), value)
+            return
+        self._own()
+        self._suffix.insert(index, value)
+
+    def append(self, value):
+        self._suffix.append(value)
+
+    def extend(self, values):
+        self._suffix.extend(values)
+
+    def pop(self, index=-1):
+        value = self[index]
+        del self[index]
+        return value
+
+    def copy(self):
+        return _CopyOnWriteInstructions(self._prefix, self._suffix.copy(), self._overrides.copy())
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
@@ -13,7 +13,7 @@ setuptools.setup(
     long_description="NetQuil is an open-source Python framework built on pyQuil designed specifically for simulating quantum networks.",
     long_description_content_type="text/markdown",
     url="https://github.com/att-innovate/netQuil",
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(exclude=["benchmarks"]),
     classifiers=(
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -0,0 +1,27 @@
+from pyquil import Program
+from pyquil.quilbase import Declare, Measurement
+from netQuil import *
+
+class Sender(Agent):
+    def run(self):
+        self.qsend('Receiver', list(self.qubits))
+
+class Receiver(Agent):
+    def run(self):
+        self.program.declare('Fiber', 'BIT', 2)
+        self.qrecv('Sender')
+
+def test_register_declared_by_agent_and_read_out_into_by_devices_is_declared_once():
+    program = Program()
+    sender = Sender(program, name='Sender', qubits=list(range(20)))
+    receiver = Receiver(program, name='Receiver')
+    QConnect(sender, receiver, transit_devices=[Fiber(length=50)])
+    result = Simulation(sender, receiver).run(trials=1, seed=2)[0]
+
+    declarations = [inst for inst in result.instructions if isinstance(inst, Declare)]
+    assert [declaration.name for declaration in declarations] == ['Fiber']
+    # Each lost qubit is read out into its own bit, after the bits declared by the agent
+    offsets = [inst.classical_reg.offset for inst in result.instructions if isinstance(inst, Measurement)]
+    assert offsets
+    assert sorted(offsets) == list(range(2, 2 + len(offsets)))
+    assert declarations[0].memory_size == 2 + len(offsets)
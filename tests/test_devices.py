@@ -0,0 +1,13 @@
+from pyquil import Program
+from netQuil import *
+
+def test_laser_counts_one_trial_per_qubit_of_a_burst():
+    laser = Laser()
+    laser.apply_batch(Program(), [0, 1, 2, 3, 4])
+    assert laser.get_stats()['trials'] == 5
+    assert 0 <= laser.get_stats()['success'] <= 5
+
+def test_fiber_counts_one_trial_per_qubit_of_a_burst():
+    fiber = Fiber(length=5)
+    fiber.apply_batch(Program(), [0, 1, 2, 3, 4])
+    assert fiber.get_stats()['trials'] == 5
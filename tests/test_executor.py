@@ -0,0 +1,22 @@
+import pytest
+
+from pyquil import Program
+from pyquil.gates import H, CNOT, MEASURE
+from netQuil.executor import BatchExecutor, DensityMatrixSimulator
+from netQuil.stabilizer import NativeSimulator
+
+class IncompleteExecutor(BatchExecutor):
+    def _state_size(self, num_qubits):
+        return 1
+
+def test_incomplete_executors_cannot_be_created():
+    with pytest.raises(TypeError):
+        IncompleteExecutor()
+
+def test_native_simulator_runs_bell_pairs():
+    program = Program()
+    ro = program.declare('ro', 'BIT', 2)
+    program += [H(0), CNOT(0, 1), MEASURE(0, ro[0]), MEASURE(1, ro[1])]
+    for executor in (DensityMatrixSimulator(seed=1), NativeSimulator(seed=1)):
+        results = executor.run(program, trials=50)
+        assert all(a == b for a, b in results)
@@ -0,0 +1,18 @@
+from pyquil import Program
+from pyquil.gates import H
+from pyquil.quilbase import Declare
+from netQuil import noise
+
+def test_readout_slot_follows_declarations_moved_by_inserted_instructions():
+    program = Program()
+    program.declare('ro', 'BIT', 1)
+    assert noise.readout_slot(program, 'Fiber').offset == 0
+    program += H(0)
+    assert noise.readout_slot(program, 'Fiber').offset == 1
+
+    # Instructions inserted ahead of the declarations move them after they were indexed
+    program._instructions.insert(0, H(0))
+    assert noise.readout_slot(program, 'Fiber').offset == 2
+
+    declarations = {inst.name: inst.memory_size for inst in program.instructions if isinstance(inst, Declare)}
+    assert declarations == {'ro': 1, 'Fiber': 3}
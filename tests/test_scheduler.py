@@ -0,0 +1,26 @@
+from pyquil import Program
+from netQuil import *
+from netQuil.connections import signal_speed
+
+class Sender(AsyncAgent):
+    async def run(self):
+        await self.csend('Receiver', [1, 0, 1])
+        self.sent_time = self.time
+
+class Receiver(AsyncAgent):
+    async def run(self):
+        self.cbits = await self.crecv('Sender')
+        self.woken_at = self.simulation.scheduler.now
+
+def test_multi_bit_cbits_are_delivered_once_the_sender_has_sent_them():
+    program = Program()
+    sender = Sender(program, name='Sender')
+    receiver = Receiver(program, name='Receiver')
+    CConnect(sender, receiver, length=10.0)
+    simulation = EventSimulation(sender, receiver)
+    receiver.simulation = simulation
+    simulation.run()
+
+    assert receiver.cbits == [1, 0, 1]
+    travel_delay = 10.0/signal_speed*3
+    assert abs(receiver.woken_at - (sender.sent_time + travel_delay)) < 1e-15
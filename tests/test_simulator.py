@@ -0,0 +1,30 @@
+import numpy as np
+
+from pyquil import Program
+from pyquil.gates import RX
+from netQuil import *
+
+class GlobalRandomDevice(Device):
+    def apply(self, program, qubits):
+        for qubit in qubits:
+            program += RX(np.random.rand(), qubit)
+        return {'delay': 0}
+
+class Sender(Agent):
+    def run(self):
+        self.qsend('Receiver', list(self.qubits))
+
+class Receiver(Agent):
+    def run(self):
+        self.qrecv('Sender')
+
+def test_parallel_trials_draw_from_independent_global_random_states():
+    program = Program()
+    sender = Sender(program, name='Sender', qubits=[0])
+    receiver = Receiver(program, name='Receiver')
+    QConnect(sender, receiver, transit_devices=[GlobalRandomDevice()])
+
+    programs = Simulation(sender, receiver).run(trials=8, workers=4, seed=1)
+    angles = [inst.params[0] for p in programs for inst in p.instructions if getattr(inst, 'name', None) == 'RX']
+    assert len(angles) == 8
+    assert len(set(angles)) == 8